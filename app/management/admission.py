@@ -0,0 +1,143 @@
+from enum import Enum, auto
+from threading import Lock
+import time
+import traceback
+
+import psutil
+
+from app.management.events import GameServerEvent, GameServerEventType
+from app.management.server import GameServer, GameServerStatus
+
+class Admission(Enum):
+    ADMITTED = auto()
+    # it will be started once enough memory frees up
+    QUEUED = auto()
+    REFUSED = auto()
+
+class MemoryAdmission:
+    """
+    Keeps servers from being started when the host doesn't have the memory for them.
+
+    Every server that isn't stopped counts with whichever is higher of its reserved memory, see `GameServer.get_memory_reservation()`,
+    and the memory it actually used in its latest stats sample. A server is only started if its reservation fits in what is left of the budget.
+    Otherwise it is queued and started once enough memory frees up, oldest first, or refused if queueing is turned off in the config.
+
+    A server that was just admitted keeps its reservation while it starts, until its next status event says it is running,
+    so servers starting at the same time can't all fit into the same memory.
+    """
+    # a queued server is checked at most this often because of stats, as every server sends them
+    STATS_CHECK_INTERVAL = 10
+
+    def __init__(self, manager: 'ServerManager'):
+        self.manager = manager
+        self._queue: list[GameServer] = []
+        # servers that were admitted but don't have a process yet
+        self._pending: set[GameServer] = set()
+        self._lock = Lock()
+        self._last_stats_check = 0
+        # a server stopping frees up memory, and so can one that uses less than it did
+        self._listener = manager.add_event_listener(self._on_event)
+
+    def get_budget(self):
+        """
+        Gets the amount of memory in MiB that servers can use together.
+        """
+        if self.manager.config.memory_budget is not None:
+            return self.manager.config.memory_budget
+        return psutil.virtual_memory().total // (1024 * 1024)
+
+    def get_used(self):
+        """
+        Gets the amount of memory in MiB that is counted as used by servers that aren't stopped, or are being started.
+        """
+        used = 0
+        for server in list(self.manager.servers.values()):
+            if server.is_stopped() and server not in self._pending:
+                continue
+            latest = server.stats_history.latest()
+            actual = latest["memory"] / (1024 * 1024) if latest is not None else 0
+            used += max(server.get_memory_reservation(), actual)
+        return used
+
+    def admit(self, server: GameServer):
+        """
+        Checks if `server` can be started, and queues it if it can't.
+        An admitted server counts as using its memory until its next status event, or until `release()` if it doesn't start after all.
+
+        :return: Whether it was admitted, queued or refused
+        """
+        with self._lock:
+            if server.get_memory_reservation() + self.get_used() <= self.get_budget():
+                if server in self._queue:
+                    self._queue.remove(server)
+                self._pending.add(server)
+                return Admission.ADMITTED
+            if not self.manager.config.queue_memory_starts:
+                return Admission.REFUSED
+            if server not in self._queue:
+                self._queue.append(server)
+            return Admission.QUEUED
+
+    def cancel(self, server: GameServer):
+        """
+        Takes a server out of the queue.
+
+        :return: True if it was queued
+        """
+        with self._lock:
+            if server in self._queue:
+                self._queue.remove(server)
+                return True
+            return False
+
+    def release(self, server: GameServer):
+        """
+        Stops counting the memory of a server that was admitted but couldn't be started.
+        """
+        with self._lock:
+            self._pending.discard(server)
+
+    def get_queue(self):
+        with self._lock:
+            return list(self._queue)
+
+    def _on_event(self, event: GameServerEvent):
+        if event.type == GameServerEventType.STATUS:
+            if event.server in self._pending:
+                with self._lock:
+                    # it's counted by its status from now on
+                    self._pending.discard(event.server)
+        elif event.type == GameServerEventType.STATS:
+            if not self._queue or time.monotonic() - self._last_stats_check < self.STATS_CHECK_INTERVAL:
+                return
+            self._last_stats_check = time.monotonic()
+        else:
+            return
+        if self._queue:
+            self._start_queued()
+
+    def _start_queued(self):
+        while True:
+            with self._lock:
+                budget = self.get_budget()
+                used = self.get_used()
+                server = self._queue[0] if self._queue else None
+                if server is None or server.get_memory_reservation() + used > budget:
+                    return
+            # started without the lock, as starting emits events that come back here.
+            # starting checks again and takes it out of the queue
+            print(f"Enough memory is free, starting server {server.game}/{server.id}")
+            try:
+                started = server.start_server()
+            except Exception:
+                # this runs inside whatever emitted the event, which shouldn't fail because of another server
+                print(f"Couldn't start server {server.game}/{server.id}")
+                traceback.print_exc()
+                self.cancel(server)
+                if server.status == GameServerStatus.QUEUED:
+                    server.status = GameServerStatus.STOPPED
+                    server.emit_status_event()
+                continue
+            if not started and server.status != GameServerStatus.QUEUED:
+                # it was stopped or started some other way since it was queued
+                self.cancel(server)
@@ -18,6 +18,27 @@ class Config(BaseModel):
     password_hash: str | None = None
     setup: bool = False
 
+    # how often to sample the resource usage of running servers, in seconds
+    stats_interval: float = 5
+    # max amount of seconds to wait for every server to stop when shutting down,
+    # servers that are still running by then are killed
+    shutdown_timeout: float = 60
+    # max amount of servers that are auto started at the same time,
+    # the next one is started once one of them is done starting or has taken longer than start_slot_timeout seconds
+    max_concurrent_starts: int = 2
+    start_slot_timeout: float = 300
+    # max MiB of memory that servers can use together, None means all the memory of the host.
+    # servers that don't fit are queued until enough memory is free, or aren't started at all if queue_memory_starts is off
+    memory_budget: int | None = None
+    queue_memory_starts: bool = True
+    # give servers without a cpu_set placement_cpus_per_server cpus each, spread over the cpus and NUMA nodes.
+    # placement_reserved_cpus are left for the manager and the rest of the host, like "0"
+    auto_placement: bool = False
+    placement_cpus_per_server: int = 2
+    placement_reserved_cpus: str = ""
+    # a cgroup v2 directory the manager can write to, servers with cgroup limits get their own cgroup in it
+    cgroup_root: str | None = None
+
     version: int = CURRENT_VERSION
 
 
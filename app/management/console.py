@@ -0,0 +1,364 @@
+from collections import deque
+import datetime
+import json
+from threading import Lock
+import time
+
+from app.management.console_log import ConsoleLog
+from app.management.console_search import ConsoleQuery, TrigramIndex, get_trigrams
+from app.management.events import ConsoleBatchEvent, ConsoleClearEvent, ConsoleLineEvent
+from app.management.multiplexer import ProcessMultiplexer, TimerHandle
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+class GameConsoleLine:
+    # a console can hold thousands of lines, so don't give each one a __dict__
+    __slots__ = ("line", "error", "time_ns", "seq", "_json")
+
+    def __init__(self, line: str, error: bool = False, time_ns: int = None, seq: int = None):
+        self.line = line
+        self.error = error
+        # unix time in nanoseconds, a datetime is only made when it is needed
+        self.time_ns = time.time_ns() if time_ns is None else time_ns
+        # sequence number of this line in the console, used as a cursor when paging through the console
+        self.seq = seq
+        self._json: str = None
+
+    @property
+    def timestamp(self):
+        return _EPOCH + datetime.timedelta(microseconds=self.time_ns // 1000)
+
+    def as_dict(self):
+        return {
+            "seq": self.seq,
+            "line": self.line,
+            "error": self.error,
+            "timestamp": self.timestamp.isoformat(),
+        }
+
+    def as_json(self):
+        """
+        Gets `as_dict()` encoded as JSON.
+        Lines never change, so this is only encoded once and then shared by every client and the log.
+        """
+        if self._json is None:
+            self._json = json.dumps(self.as_dict())
+        return self._json
+
+class ConsoleBuffer:
+    """
+    Fixed capacity ring buffer of console lines.
+
+    Once either the line or the size budget is exceeded the oldest lines are evicted,
+    so the memory used by a console stays flat no matter how long the server has been running.
+    The size budget is measured in characters, as encoding every line just to count bytes isn't worth it.
+    It counts the cached JSON of each line along with its text, as every line is encoded for the log anyway.
+
+    Lines must be added with increasing and contiguous sequence numbers,
+    which lets any line be looked up by its sequence number in constant time.
+    """
+    def __init__(self, max_lines: int, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._lines: list[GameConsoleLine] = [None] * max(max_lines, 1)
+        self._start = 0
+        self._count = 0
+
+    @property
+    def max_lines(self):
+        return len(self._lines)
+
+    @max_lines.setter
+    def max_lines(self, max_lines: int):
+        """
+        Resizes the buffer. Any lines that no longer fit are dropped.
+        """
+        max_lines = max(max_lines, 1)
+        if max_lines == len(self._lines):
+            return
+        lines = list(self)
+        self._lines = [None] * max_lines
+        self._start = 0
+        self._count = 0
+        self.size = 0
+        for line in lines[-max_lines:]:
+            self.append(line)
+
+    @property
+    def first_seq(self):
+        """The sequence number of the oldest line in the buffer, or `None` if it is empty"""
+        return self[0].seq if self._count else None
+
+    @property
+    def last_seq(self):
+        """The sequence number of the newest line in the buffer, or `None` if it is empty"""
+        return self[-1].seq if self._count else None
+
+    def append(self, line: GameConsoleLine):
+        """
+        Adds `line` to the end of the buffer.
+
+        :param line: The line to add
+        :return: A list of lines that were evicted to make room, oldest first
+        """
+        evicted = []
+        if self._count == len(self._lines):
+            evicted.append(self._pop_oldest())
+        self._lines[(self._start + self._count) % len(self._lines)] = line
+        self._count += 1
+        self.size += self._size_of(line)
+        # always keep the newest line, even if it is bigger than the whole budget by itself
+        while self._count > 1 and self.size > self.max_size:
+            evicted.append(self._pop_oldest())
+        return evicted
+
+    def drain(self):
+        """
+        Removes all lines from the buffer.
+
+        :return: The removed lines, oldest first
+        """
+        lines = list(self)
+        self._lines = [None] * len(self._lines)
+        self._start = 0
+        self._count = 0
+        self.size = 0
+        return lines
+
+    def get_range(self, before: int = None, after: int = None, limit: int = 100):
+        """
+        Gets up to `limit` lines, only touching the lines that are actually returned.
+
+        If `after` is set, this returns the oldest lines with a sequence number greater than it.
+        Otherwise this returns the newest lines, with a sequence number less than `before` if it is set.
+
+        :param before: Only return lines before this sequence number
+        :param after: Only return lines after this sequence number, takes priority over `before`
+        :param limit: The maximum amount of lines to return
+        :return: The lines, oldest first
+        """
+        if not self._count or limit <= 0:
+            return []
+        first_seq = self.first_seq
+        if after is not None:
+            start = max(after + 1 - first_seq, 0)
+            end = min(start + limit, self._count)
+        else:
+            end = self._count if before is None else min(max(before - first_seq, 0), self._count)
+            start = max(end - limit, 0)
+        return [self[i] for i in range(start, end)]
+
+    def _pop_oldest(self):
+        line = self._lines[self._start]
+        self._lines[self._start] = None
+        self._start = (self._start + 1) % len(self._lines)
+        self._count -= 1
+        self.size -= self._size_of(line)
+        return line
+
+    @staticmethod
+    def _size_of(line: GameConsoleLine):
+        return len(line.line) + len(line.as_json())
+
+    def __getitem__(self, index: int):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("console buffer index out of range")
+        return self._lines[(self._start + index) % len(self._lines)]
+
+    def __iter__(self):
+        return (self[i] for i in range(self._count))
+
+    def __len__(self):
+        return self._count
+
+class GameConsole:
+    """
+    The console of a server, which keeps the newest lines in memory and saves every line to the log.
+
+    Each line is emitted as a `ConsoleLineEvent` right away, for listeners that need to see every line as it comes in.
+    Lines are also collected for up to `console_batch_window` seconds and emitted together as a `ConsoleBatchEvent`,
+    which is what clients should use, so a flood of output doesn't become a flood of events.
+    The first line after the console has been quiet for a window is emitted right away,
+    so the response to a command isn't held back.
+    """
+    # max amount of lines in one batch, a batch is emitted early once it is this big
+    BATCH_MAX_LINES = 500
+
+    def __init__(self, server: 'GameServer'):
+        self.server = server
+        # only the newest lines are kept in memory, but every line is saved to the log
+        self.lines = ConsoleBuffer(server.console_max_lines, server.console_max_size)
+        self.log = ConsoleLog(server)
+        # lets the lines in memory be searched without checking every line
+        self.index = TrigramIndex()
+        self._next_seq = 0
+        # lines are added on the multiplexer thread while requests read them on others, so the buffer needs to be guarded
+        self._lock = Lock()
+        self._batch: list[GameConsoleLine] = []
+        self._batch_timer: TimerHandle = None
+        self._batch_lock = Lock()
+
+    def add_line(self, line, error = False):
+        trigrams = get_trigrams(line)
+        with self._lock:
+            console_line = GameConsoleLine(line, error, seq=self._next_seq)
+            self._next_seq += 1
+            # settings can change while the server is running, so always use the current budget
+            self.lines.max_lines = self.server.console_max_lines
+            self.lines.max_size = self.server.console_max_size
+            self.lines.append(console_line)
+            self.index.add(console_line.seq, trigrams)
+            self.index.drop_before(self.lines.first_seq)
+            self.log.write(console_line, trigrams)
+        self.server.triggers.scan(console_line)
+        self.server.emit_event(ConsoleLineEvent(console_line))
+        self._add_to_batch(console_line)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "lines": [line.as_dict() for line in self.lines],
+            }
+
+    def get_page(self, before: int = None, after: int = None, limit: int = 100):
+        """
+        Gets part of the console, see `ConsoleBuffer.get_range()` for how the parameters work.
+
+        The returned JSON also has the sequence numbers of the oldest and newest lines still in memory,
+        so a client can tell if there are any more lines to load.
+
+        :return: The page encoded as JSON, built from the cached JSON of each line
+        """
+        with self._lock:
+            lines = ",".join(line.as_json() for line in self.lines.get_range(before, after, limit))
+            first_seq, last_seq = json.dumps(self.lines.first_seq), json.dumps(self.lines.last_seq)
+        return f'{{"lines": [{lines}], "first_seq": {first_seq}, "last_seq": {last_seq}}}'
+
+    def tail(self, limit: int):
+        """
+        Gets the text of the newest `limit` lines, oldest first.
+        """
+        with self._lock:
+            return [line.line for line in self.lines.get_range(limit=limit)]
+
+    def restore_from_log(self):
+        """
+        Fills the lines in memory with the newest lines of the latest log session, and continues that session.
+        Used when reattaching to a server that kept running while the manager was stopped,
+        as the shim only sends the output that no manager got before.
+        """
+        session = self.log.resume_latest_session()
+        if session is None:
+            return
+        lines = []
+        for raw_line in self.log.tail_session(session, self.server.console_max_lines):
+            data = json.loads(raw_line)
+            time_ns = (datetime.datetime.fromisoformat(data["timestamp"]) - _EPOCH) // datetime.timedelta(microseconds=1) * 1000
+            line = GameConsoleLine(data["line"], data["error"], time_ns, data["seq"])
+            line._json = raw_line.rstrip("\n")
+            # the buffer needs contiguous sequence numbers, so only the lines after a gap are kept
+            if lines and line.seq != lines[-1].seq + 1:
+                lines.clear()
+            lines.append(line)
+        with self._lock:
+            self.lines.drain()
+            self.index.clear(lines[0].seq if lines else self._next_seq)
+            for line in lines:
+                self.lines.append(line)
+                self.index.add(line.seq, get_trigrams(line.line))
+            if lines:
+                self._next_seq = lines[-1].seq + 1
+
+    def clear(self):
+        """
+        Clears the lines in memory and ends the current log session, so the next line starts a new one.
+        """
+        # lines from before the clear shouldn't show up after it
+        self.flush_batch()
+        with self._lock:
+            self.lines.drain()
+            self.index.clear(self._next_seq)
+            self.log.end_session()
+        self.server.emit_event(ConsoleClearEvent())
+
+    def flush_batch(self):
+        """
+        Emits the lines waiting to be batched right away.
+        """
+        with self._batch_lock:
+            if self._batch_timer is not None:
+                self._batch_timer.cancel()
+                self._batch_timer = None
+            self._emit_batch()
+
+    def _add_to_batch(self, line: GameConsoleLine):
+        window = self.server.console_batch_window
+        with self._batch_lock:
+            self._batch.append(line)
+            if window <= 0 or len(self._batch) >= self.BATCH_MAX_LINES:
+                self._emit_batch()
+            elif self._batch_timer is None:
+                # the console was quiet, so send this line right away and batch the ones that follow it
+                self._emit_batch()
+                self._batch_timer = ProcessMultiplexer.get().call_later(window, self._on_batch_timer)
+
+    def _on_batch_timer(self):
+        with self._batch_lock:
+            if not self._batch:
+                # nothing came in during the window, so the next line gets sent right away
+                self._batch_timer = None
+                return
+            self._emit_batch()
+            self._batch_timer = ProcessMultiplexer.get().call_later(self.server.console_batch_window, self._on_batch_timer)
+
+    def _emit_batch(self):
+        # called while holding the batch lock, so batches can't be emitted out of order
+        if not self._batch:
+            return
+        lines, self._batch = self._batch, []
+        self.server.emit_event(ConsoleBatchEvent(lines))
+
+    def search(self, query: ConsoleQuery, limit: int = None):
+        """
+        Searches the lines in memory, then every saved log session.
+        Matches are found newest first, and are found lazily so they can be streamed.
+
+        :param query: What to search for
+        :param limit: The maximum amount of matches, defaults to None meaning no limit
+        :return: A generator of matching lines as dicts, with the name of the log session they are from
+        """
+        with self._lock:
+            first_seq = self.lines.first_seq
+            if query.trigrams is not None:
+                # resizing the buffer drops lines without the index knowing, so skip those
+                lines = [self.lines[seq - first_seq] for seq in self.index.get_candidates(query.trigrams) if seq >= first_seq]
+            else:
+                lines = list(self.lines)
+            session = self.log.latest_session()
+        if limit is not None and limit <= 0:
+            return
+        count = 0
+        for line in reversed(lines):
+            if query.matches(line.line, line.timestamp):
+                yield line.as_dict() | {"session": session}
+                count += 1
+                if count == limit:
+                    return
+        # lines in memory are also in the current session's log, so don't find them twice
+        for match in self.log.search(query, session, first_seq):
+            yield match
+            count += 1
+            if count == limit:
+                return
+
+    def get_str(self):
+        """
+        Concatenates all lines of output into one string.
+        """
+        with self._lock:
+            return ''.join([line.line for line in self.lines])
+
+    def print(self):
+        print(self.get_str())
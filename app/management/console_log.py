@@ -0,0 +1,299 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import gzip
+import json
+import os
+import shutil
+from threading import Lock
+import time
+
+from app.management.console_search import BloomFilter
+from app.management.multiplexer import ProcessMultiplexer, TimerHandle
+from app.management.storage import Directory, File
+
+# rotated segments are compressed on this thread one at a time, so writing to the console never has to wait for it
+_compressor = ThreadPoolExecutor(1, thread_name_prefix="ConsoleLogCompressor")
+
+class ConsoleLog:
+    """
+    Saves the console output of a server to log files.
+
+    Each run of the server gets its own session directory, which is split into segments
+    once the current one gets too big or too old. Finished segments are gzipped in the background.
+    Lines are stored as JSON, the same way they are sent by the API.
+
+    Lines are buffered and written in batches, either once the buffer is big enough or after `FLUSH_INTERVAL` seconds,
+    so a flood of output doesn't turn into a write for every line.
+    """
+    # name of the directory in the server directory that logs are saved to
+    DIRECTORY = "console_logs"
+    # amount of characters to buffer before writing them
+    BUFFER_SIZE = 64 * 1024
+    # max amount of seconds lines are buffered before writing them
+    FLUSH_INTERVAL = 1
+
+    SEGMENT_EXTENSION = ".jsonl"
+    COMPRESSED_EXTENSION = ".gz"
+    INDEX_EXTENSION = ".index.json"
+
+    def __init__(self, server: 'GameServer'):
+        self.server = server
+        self._lock = Lock()
+        self._buffer: list[str] = []
+        self._buffer_size = 0
+        # trigrams and time range of the buffered lines and of the current segment,
+        # saved next to each segment so searches can skip segments that can't match
+        self._buffer_trigrams: set[str] = set()
+        self._buffer_times: list[int] = []
+        self._segment_trigrams: set[str] = set()
+        self._segment_times: list[int] = []
+        self._flush_timer: TimerHandle = None
+        self._session: Directory = None
+        self._latest_session: str = None
+        self._file = None
+        self._segment = 0
+        self._segment_size = 0
+        self._segment_started = 0
+
+    def get_directory(self):
+        return self.server.get_directory().get_directory(self.DIRECTORY)
+
+    def write(self, line: 'GameConsoleLine', trigrams: set[str]):
+        """
+        Adds a line to the current session, starting a new session if there isn't one.
+
+        :param line: The line to add
+        :param trigrams: The trigrams of the line, see `console_search.get_trigrams()`
+        """
+        data = line.as_json() + "\n"
+        with self._lock:
+            if self._session is None:
+                self._start_session()
+            self._buffer.append(data)
+            self._buffer_size += len(data)
+            self._buffer_trigrams |= trigrams
+            self._buffer_times.append(line.time_ns)
+            if self._buffer_size >= self.BUFFER_SIZE:
+                self._flush()
+            elif self._flush_timer is None:
+                self._flush_timer = ProcessMultiplexer.get().call_later(self.FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        """
+        Writes any buffered lines to disk.
+        """
+        with self._lock:
+            self._flush()
+
+    def end_session(self):
+        """
+        Writes any buffered lines and closes the current session.
+        The next line written will start a new session.
+        """
+        with self._lock:
+            if self._session is None:
+                return
+            self._flush()
+            self._close_segment()
+            self._session = None
+
+    def resume_latest_session(self):
+        """
+        Continues the newest saved session instead of starting a new one with the next line,
+        used when reattaching to a server that kept running while the manager was stopped.
+
+        :return: The name of the session, or None if there isn't one or a session is already open
+        """
+        sessions = self.list_sessions()
+        with self._lock:
+            if self._session is not None or not sessions:
+                return None
+            session = self.get_directory().get_directory(sessions[-1]["session"])
+            segments = self._list_segments(session)
+            # new lines go in a new segment, as the last one might have been left without an index
+            self._segment = max(int(segment.name.split(".")[0]) for segment in segments) + 1 if segments else 0
+            self._session = session
+            self._latest_session = session.name
+            return session.name
+
+    def tail_session(self, session: str, limit: int):
+        """
+        Reads the newest `limit` lines of a session, only reading the segments they are in.
+
+        :return: A list of lines as JSON strings, oldest first
+        """
+        self.flush()
+        chunks = []
+        count = 0
+        for segment in reversed(self._list_segments(self.get_directory().get_directory(session))):
+            if count >= limit:
+                break
+            lines = list(self._read_segment(segment))[-(limit - count):]
+            chunks.append(lines)
+            count += len(lines)
+        return [line for lines in reversed(chunks) for line in lines]
+
+    def latest_session(self):
+        """Gets the name of the session the newest lines were saved to, even if it has ended"""
+        return self._latest_session
+
+    def search(self, query: 'ConsoleQuery', skip_session: str = None, skip_from_seq: int = None):
+        """
+        Searches every saved session, newest first.
+        Segments that can't match because of their time range or trigrams are skipped without being read.
+
+        :param query: What to search for
+        :param skip_session: A session to skip some lines in, used to skip lines that were already searched
+        :param skip_from_seq: Lines in `skip_session` with this sequence number or higher are skipped
+        :return: A generator of matching lines as dicts, with the name of the session they are from
+        """
+        self.flush()
+        for session in reversed(self.list_sessions()):
+            name = session["session"]
+            directory = self.get_directory().get_directory(name)
+            for segment in reversed(self._list_segments(directory)):
+                index_file = directory.get_file(segment.name.split(".")[0] + self.INDEX_EXTENSION)
+                if index_file.exists():
+                    index = json.loads(index_file.get_contents())
+                    first, last = (datetime.datetime.fromisoformat(time) for time in index["time_range"])
+                    if not query.in_time_range(first, last) or not query.might_match_segment(BloomFilter.loads(index["bloom"])):
+                        continue
+                matches = []
+                for raw_line in self._read_segment(segment):
+                    line = query.matches_raw(raw_line)
+                    if line is None:
+                        continue
+                    if name == skip_session and skip_from_seq is not None and line["seq"] >= skip_from_seq:
+                        continue
+                    matches.append(line | {"session": name})
+                yield from reversed(matches)
+
+    def list_sessions(self):
+        """
+        Gets every saved session, oldest first.
+
+        :return: A list of dicts with the name of each session and its segments
+        """
+        directory = self.get_directory()
+        if not directory.exists():
+            return []
+        return [
+            {
+                "session": session.name,
+                "segments": [{"name": segment.name, "size": os.path.getsize(segment.path)} for segment in self._list_segments(session)],
+            }
+            for session in sorted(directory.list_files(), key=lambda file: file.name)
+            if isinstance(session, Directory)
+        ]
+
+    def session_exists(self, session: str):
+        directory = self.get_directory()
+        # only allow names that are actually in the directory, so this can't be used to get other files
+        return directory.exists() and session in os.listdir(directory.path)
+
+    def iter_session(self, session: str):
+        """
+        Reads every line saved in a session, decompressing segments as needed.
+
+        :param session: The name of the session, see `list_sessions()`
+        :return: A generator of lines, as JSON strings
+        """
+        for segment in self._list_segments(self.get_directory().get_directory(session)):
+            yield from self._read_segment(segment)
+
+    def _read_segment(self, segment: File):
+        path = segment.path
+        try:
+            if not path.endswith(self.COMPRESSED_EXTENSION):
+                try:
+                    file = open(path, "rt")
+                except FileNotFoundError:
+                    # it was compressed in the background since it was listed
+                    path += self.COMPRESSED_EXTENSION
+            if path.endswith(self.COMPRESSED_EXTENSION):
+                file = gzip.open(path, "rt")
+        except FileNotFoundError:
+            # the whole session was removed since it was listed
+            return
+        with file:
+            yield from file
+
+    def _list_segments(self, session: Directory):
+        segments = [file for file in session.list_files() if file.name.endswith((self.SEGMENT_EXTENSION, self.SEGMENT_EXTENSION + self.COMPRESSED_EXTENSION))]
+        # the segment number is the first part of the name, and doesn't change when it is compressed
+        return sorted(segments, key=lambda file: file.name.split(".")[0])
+
+    def _start_session(self):
+        directory = self.get_directory()
+        name = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d-%H%M%S")
+        session = directory.get_directory(name)
+        suffix = 1
+        while session.exists():
+            session = directory.get_directory(f"{name}-{suffix}")
+            suffix += 1
+        session.ensure_exists()
+        self._session = session
+        self._latest_session = session.name
+        self._segment = 0
+        _compressor.submit(self._remove_old_sessions, directory, session.name, self.server.console_log_max_sessions)
+
+    def _flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if not self._buffer:
+            return
+        if self._file is not None and (self._segment_size >= self.server.console_log_max_size
+                                       or time.monotonic() - self._segment_started >= self.server.console_log_max_age):
+            self._close_segment()
+        if self._file is None:
+            self._file = self._session.get_file(f"{self._segment:04}{self.SEGMENT_EXTENSION}").open("at")
+            self._segment_started = time.monotonic()
+        self._file.write("".join(self._buffer))
+        self._file.flush()
+        self._segment_size += self._buffer_size
+        self._segment_trigrams |= self._buffer_trigrams
+        self._segment_times += (self._buffer_times[0], self._buffer_times[-1])
+        self._buffer.clear()
+        self._buffer_size = 0
+        self._buffer_trigrams = set()
+        self._buffer_times.clear()
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+        self._file.close()
+        index_path = self._session.get_file(f"{self._segment:04}{self.INDEX_EXTENSION}").path
+        _compressor.submit(self._write_index, index_path, self._segment_trigrams, min(self._segment_times), max(self._segment_times))
+        _compressor.submit(self._compress, self._file.name)
+        self._segment_trigrams = set()
+        self._segment_times = []
+        self._file = None
+        self._segment += 1
+        self._segment_size = 0
+
+    @staticmethod
+    def _write_index(path: str, trigrams: set[str], first_ns: int, last_ns: int):
+        # stored the same way as line timestamps
+        epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+        first, last = (epoch + datetime.timedelta(microseconds=time_ns // 1000) for time_ns in (first_ns, last_ns))
+        with open(path, "wt") as file:
+            json.dump({
+                "time_range": [first.isoformat(), last.isoformat()],
+                "bloom": BloomFilter.from_items(trigrams).dumps(),
+            }, file)
+
+    @classmethod
+    def _compress(cls, path: str):
+        # compress to a temporary name, so a half written segment is never read
+        with open(path, "rb") as src, gzip.open(path + cls.COMPRESSED_EXTENSION + ".tmp", "wb") as dest:
+            shutil.copyfileobj(src, dest)
+        os.replace(path + cls.COMPRESSED_EXTENSION + ".tmp", path + cls.COMPRESSED_EXTENSION)
+        os.remove(path)
+
+    @staticmethod
+    def _remove_old_sessions(directory: Directory, current: str, max_sessions: int):
+        # the current session is always kept, even if no sessions should be
+        sessions = sorted(file.path for file in directory.list_files() if isinstance(file, Directory) and file.name != current)
+        for session in sessions[:max(len(sessions) - max(max_sessions - 1, 0), 0)]:
+            shutil.rmtree(session)
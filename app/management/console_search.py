@@ -0,0 +1,176 @@
+from array import array
+import base64
+from bisect import bisect_left
+import datetime
+import json
+import re
+import zlib
+
+def get_trigrams(text: str):
+    """
+    Gets every unique set of 3 characters in `text`, lowercased so searches can ignore case.
+    """
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class TrigramIndex:
+    """
+    Maps trigrams to the sequence numbers of the console lines in memory that contain them.
+
+    Lines are added in order, so each posting list stays sorted and lines that are no longer in memory
+    can be skipped with a binary search. The skipped entries are only removed from time to time,
+    once enough lines have been dropped, so dropping a line is free most of the time.
+    """
+    # amount of lines to drop before removing them from the posting lists
+    COMPACT_INTERVAL = 5000
+
+    def __init__(self):
+        self._postings: dict[str, array] = {}
+        self.first_seq = 0
+        self._dropped = 0
+
+    def add(self, seq: int, trigrams: set[str]):
+        for trigram in trigrams:
+            postings = self._postings.get(trigram)
+            if postings is None:
+                postings = self._postings[trigram] = array('q')
+            postings.append(seq)
+
+    def drop_before(self, first_seq: int):
+        """
+        Forgets every line with a sequence number lower than `first_seq`.
+        """
+        if first_seq <= self.first_seq:
+            return
+        self._dropped += first_seq - self.first_seq
+        self.first_seq = first_seq
+        if self._dropped >= self.COMPACT_INTERVAL:
+            self._compact()
+
+    def clear(self, first_seq: int):
+        """
+        Forgets every line, with `first_seq` being the sequence number of the next line.
+        """
+        self._postings.clear()
+        self.first_seq = first_seq
+        self._dropped = 0
+
+    def get_candidates(self, trigrams: set[str]):
+        """
+        Gets the sequence numbers of lines that contain every trigram in `trigrams`.
+        These lines still need to be checked, as having all the trigrams doesn't mean the whole text is in the line.
+
+        :return: A sorted list of sequence numbers
+        """
+        postings = []
+        for trigram in trigrams:
+            trigram_postings = self._postings.get(trigram)
+            if trigram_postings is None:
+                return []
+            postings.append(trigram_postings)
+        # start with the rarest trigram, so the set being intersected is as small as possible
+        postings.sort(key=len)
+        candidates = set(postings[0][bisect_left(postings[0], self.first_seq):])
+        for trigram_postings in postings[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(trigram_postings[bisect_left(trigram_postings, self.first_seq):])
+        return sorted(candidates)
+
+    def _compact(self):
+        for trigram in list(self._postings):
+            postings = self._postings[trigram]
+            start = bisect_left(postings, self.first_seq)
+            if start == len(postings):
+                del self._postings[trigram]
+            elif start:
+                self._postings[trigram] = postings[start:]
+        self._dropped = 0
+
+class BloomFilter:
+    """
+    Compact set of trigrams that can say for sure that a trigram isn't in it, used to skip log segments when searching.
+    Uses crc32 for hashing, as it needs to be the same across runs, unlike `hash()`.
+    """
+    HASHES = 3
+    # bits per item, gives roughly a 3% false positive rate with 3 hashes
+    BITS_PER_ITEM = 8
+
+    def __init__(self, bits: bytearray):
+        self.bits = bits
+
+    @classmethod
+    def from_items(cls, items: set[str]):
+        bloom = cls(bytearray(max(len(items) * cls.BITS_PER_ITEM // 8, 64)))
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def _positions(self, item: str):
+        data = item.encode("utf8")
+        size = len(self.bits) * 8
+        return (zlib.crc32(data, seed) % size for seed in range(self.HASHES))
+
+    def dumps(self):
+        return base64.b64encode(self.bits).decode("ascii")
+
+    @classmethod
+    def loads(cls, data: str):
+        return cls(bytearray(base64.b64decode(data)))
+
+class ConsoleQuery:
+    """
+    A search for console lines, matching text or a regex and optionally only in a time range.
+    """
+    def __init__(self, text: str, regex = False, case_sensitive = False, start: datetime.datetime = None, end: datetime.datetime = None):
+        """
+        :param text: The text to look for
+        :param regex: Whether `text` is a regex instead of plain text
+        :param case_sensitive: Whether the case of letters has to match
+        :param start: Only match lines from this time or later
+        :param end: Only match lines from this time or earlier
+        :raises re.error: If `regex` is set and `text` isn't a valid regex
+        """
+        flags = 0 if case_sensitive else re.IGNORECASE
+        self.pattern = re.compile(text if regex else re.escape(text), flags)
+        # times without a timezone are assumed to be UTC, the same as console lines
+        self.start = start.replace(tzinfo=start.tzinfo or datetime.timezone.utc) if start else None
+        self.end = end.replace(tzinfo=end.tzinfo or datetime.timezone.utc) if end else None
+        # trigrams can only narrow down plain text searches, a regex has to check every line
+        self.trigrams = get_trigrams(text) if not regex and len(text) >= 3 else None
+        # plain text that doesn't get escaped in JSON can be looked for in the raw JSON of a line,
+        # so only lines that might match have to be decoded
+        lowered = text.lower()
+        self.raw_filter = lowered if not regex and json.dumps(lowered)[1:-1] == lowered else None
+
+    def in_time_range(self, first: datetime.datetime, last: datetime.datetime):
+        """Checks if any time between `first` and `last` could match"""
+        return (self.start is None or last >= self.start) and (self.end is None or first <= self.end)
+
+    def matches(self, line: str, timestamp: datetime.datetime):
+        if not self.in_time_range(timestamp, timestamp):
+            return False
+        return self.pattern.search(line) is not None
+
+    def matches_raw(self, raw_line: str):
+        """
+        Checks a line stored as JSON, without decoding it unless it might match.
+
+        :return: The decoded line if it matches, otherwise None
+        """
+        if self.raw_filter is not None and self.raw_filter not in raw_line.lower():
+            return None
+        line = json.loads(raw_line)
+        if self.matches(line["line"], datetime.datetime.fromisoformat(line["timestamp"])):
+            return line
+        return None
+
+    def might_match_segment(self, bloom: BloomFilter):
+        return self.trigrams is None or all(trigram in bloom for trigram in self.trigrams)
@@ -1,21 +1,30 @@
+from collections import Counter, deque
 from enum import Enum, auto
+import json
+import secrets
+from threading import Lock
 
 class GameServerEventType(Enum):
     # used so that if a plugin or something wants to send an event they don't have to add an extra type
     CUSTOM = 0
     STATUS = auto()
     CONSOLE_LINE = auto()
+    # many console lines at once, see `GameConsole` for when lines are batched
+    CONSOLE_BATCH = auto()
     CONSOLE_CLEAR = auto()
+    STATS = auto()
 
 class GameServerEvent:
     type = GameServerEventType.CUSTOM
+    # whether a client that reconnects should get this event again if it missed it, see `GameServerEventLog`
+    replayable = True
 
     def __init__(self, type: GameServerEventType = None, **extra_data):
         if type is not None:
             self.type = type
-        # used to store the current listener being called in the dispatch,
-        # so that the handler function can easily access it
-        self.listener: GameServerEventListener = None
+        # the server that emitted this event and its sequence number on that server, set when it is emitted
+        self.server: GameServer = None
+        self.seq: int = None
         self.extra_data = extra_data
 
     def as_dict(self):
@@ -41,8 +50,22 @@ class GameServerEvent:
         """
         return self.extra_data
 
+    def data_json(self):
+        """
+        Gets `data_dict()` encoded as JSON.
+        """
+        return json.dumps(self.data_dict())
+
+    def get_line_count(self):
+        """
+        Gets the amount of console lines this event holds, which `GameServerEventLog` keeps a limit on.
+        """
+        return 0
+
 class ConsoleLineEvent(GameServerEvent):
     type = GameServerEventType.CONSOLE_LINE
+    # the same lines are also in batch events, which are what clients get
+    replayable = False
 
     def __init__(self, line: 'GameConsoleLine'):
         super().__init__()
@@ -50,7 +73,27 @@ class ConsoleLineEvent(GameServerEvent):
 
     def data_dict(self):
         return self.line.as_dict()
+
+    def data_json(self):
+        # every client gets the same line, so use the JSON cached on it
+        return self.line.as_json()
     
+class ConsoleBatchEvent(GameServerEvent):
+    type = GameServerEventType.CONSOLE_BATCH
+
+    def __init__(self, lines: list['GameConsoleLine']):
+        super().__init__()
+        self.lines = lines
+
+    def data_dict(self):
+        return {"lines": [line.as_dict() for line in self.lines]}
+
+    def data_json(self):
+        return f'{{"lines": [{",".join(line.as_json() for line in self.lines)}]}}'
+
+    def get_line_count(self):
+        return len(self.lines)
+
 class ConsoleClearEvent(GameServerEvent):
     type = GameServerEventType.CONSOLE_CLEAR
     
@@ -64,19 +107,158 @@ class StatusEvent(GameServerEvent):
     def data_dict(self):
         return {"status": self.status.name}
 
+class StatsEvent(GameServerEvent):
+    type = GameServerEventType.STATS
+    # a new sample comes every few seconds, old ones aren't worth sending again
+    replayable = False
+
+    def __init__(self, stats: dict):
+        super().__init__()
+        self.stats = stats
+
+    def data_dict(self):
+        return self.stats
+
 class GameServerEventListener:
-    def __init__(self, func, filter = None):
+    def __init__(self, func, filter = None, dispatcher: 'GameServerEventDispatcher' = None):
         self.func = func
         self.filter = filter
+        self.dispatcher = dispatcher
         self._registered = True
 
     def deregister(self):
         self._registered = False
+        if self.dispatcher is not None:
+            self.dispatcher.remove(self)
 
     def call(self, event):
         if self.filter is not None and event.type != self.filter:
             return
         self.func(event)
 
+class GameServerEventDispatcher:
+    """
+    Keeps track of event listeners and calls the ones that want each event.
+
+    Listeners are grouped by the event type they want, so an event only goes through the listeners that want it.
+    Adding or removing a listener only updates the groups it is in. The groups are tuples that are replaced instead of changed,
+    so dispatching doesn't allocate anything and can happen on any thread without taking the lock.
+    Removed listeners are skipped, and only cleaned out of a group once they make up half of it, so removing is O(1) on average.
+    """
+    def __init__(self):
+        # dicts are used as ordered sets, so listeners are called in the order they were added
+        self._listeners: dict[GameServerEventListener, None] = {}
+        self._lock = Lock()
+        # event type -> listeners to call for it
+        self._by_type: dict[GameServerEventType, tuple[GameServerEventListener, ...]] = {type: () for type in GameServerEventType}
+        # listeners without a filter, used for event types nobody filters on
+        self._unfiltered: tuple[GameServerEventListener, ...] = ()
+        # amount of removed listeners still in each group, keyed by event type, or None for `_unfiltered`
+        self._removed: Counter = Counter()
+
+    def add(self, func, filter: GameServerEventType = None):
+        """
+        Calls `func(event)` for every event, or only events of type `filter` if it isn't None.
+
+        :return: The listener, which can be removed with `deregister()`
+        """
+        listener = GameServerEventListener(func, filter, self)
+        with self._lock:
+            self._listeners[listener] = None
+            if filter is None:
+                self._unfiltered += (listener,)
+                for type in list(self._by_type):
+                    self._by_type[type] += (listener,)
+            elif filter in self._by_type:
+                self._by_type[filter] += (listener,)
+            else:
+                # a type that isn't one of `GameServerEventType`, which gets every listener without a filter too
+                self._by_type[filter] = tuple(other for other in self._unfiltered if other._registered) + (listener,)
+        return listener
+
+    def remove(self, listener: GameServerEventListener):
+        with self._lock:
+            if self._listeners.pop(listener, False) is False:
+                return
+            listener._registered = False
+            for key in ([*self._by_type, None] if listener.filter is None else [listener.filter]):
+                group = self._unfiltered if key is None else self._by_type[key]
+                self._removed[key] += 1
+                if self._removed[key] * 2 < len(group):
+                    continue
+                group = tuple(other for other in group if other._registered)
+                self._removed[key] = 0
+                if key is None:
+                    self._unfiltered = group
+                else:
+                    self._by_type[key] = group
+
+    def dispatch(self, event: GameServerEvent):
+        for listener in self._by_type.get(event.type, self._unfiltered):
+            # it might have been removed, on this thread or another one
+            if listener._registered:
+                listener.func(event)
+
+    def __len__(self):
+        return len(self._listeners)
+
+class GameServerEventLog:
+    """
+    Numbers the events of a server in the order they are emitted, and keeps the newest ones
+    so that a client that reconnects can get only the events it missed.
+
+    Events are identified by `get_id()`, which includes a random epoch that is different every time the app starts,
+    so an id from before a restart is never mistaken for a current one.
+
+    Besides the amount of events, the console lines they hold are limited by `max_lines`,
+    as a batch event can hold hundreds of lines and the log shouldn't keep more of them alive than the console does.
+    The newest event is always kept.
+    """
+    def __init__(self, size: int, max_lines: int = None):
+        self.epoch = secrets.token_hex(4)
+        self.size = size
+        self.max_lines = max_lines
+        self._events: deque[GameServerEvent] = deque()
+        # console lines held by the events in the log
+        self._lines = 0
+        self._next_seq = 0
+        # sequence number of the newest event that no longer fits in the log
+        self._dropped_seq = -1
+        self._lock = Lock()
+
+    def add(self, event: GameServerEvent):
+        """
+        Gives `event` the next sequence number, and keeps it if it is replayable.
+        """
+        with self._lock:
+            event.seq = self._next_seq
+            self._next_seq += 1
+            if not event.replayable:
+                return
+            self._events.append(event)
+            self._lines += event.get_line_count()
+            while len(self._events) > 1 and (len(self._events) > self.size or (self.max_lines is not None and self._lines > self.max_lines)):
+                dropped = self._events.popleft()
+                self._lines -= dropped.get_line_count()
+                self._dropped_seq = dropped.seq
+
+    def get_id(self, event: GameServerEvent):
+        return f"{self.epoch}-{event.seq}"
+
+    def get_since(self, event_id: str):
+        """
+        Gets the replayable events emitted after the event with the id `event_id`, oldest first.
+
+        :return: A list of events, or None if the id isn't from this log or some events after it were already dropped
+        """
+        epoch, _, seq = event_id.partition("-")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self._lock:
+            if seq >= self._next_seq or seq < self._dropped_seq:
+                return None
+            return [event for event in self._events if event.seq > seq]
+
 # mandatory "i hate circular imports" here
 from app.management.server import *
@@ -0,0 +1,224 @@
+import asyncio
+from threading import Thread
+import time
+import traceback
+
+from app.management.events import GameServerEventType, StatusEvent
+from app.management.server import GameServer, GameServerStatus
+
+class HibernationProxy:
+    """
+    Listens on the public port of a hibernating server and passes connections on to the port the server really uses.
+
+    The first connection to a stopped server starts it, and is held until the server is running.
+    Once nobody has been connected for `hibernate_idle_timeout` seconds, `Hibernator` stops the server again.
+
+    Only TCP is proxied, so this doesn't work for games that use UDP.
+    Every connection counts, so something like a server list ping also starts the server.
+    """
+    # amount of bytes to pass on at a time
+    CHUNK_SIZE = 64 * 1024
+    # the server might start listening a bit after it says it's ready, so keep trying to connect for this many seconds
+    CONNECT_RETRY_TIME = 30
+    CONNECT_RETRY_INTERVAL = 0.5
+
+    def __init__(self, hibernator: 'Hibernator', server: GameServer):
+        self.hibernator = hibernator
+        self.server = server
+        self.port = server.hibernate_port
+        self.server_port = server.hibernate_server_port
+        self.connections = 0
+        # when the last connection closed, or the server started
+        self.last_active = time.monotonic()
+        self.status = server.status
+        self._listening: asyncio.Server = None
+        # both sides of every connection, so they can be closed along with the proxy
+        self._writers: set[asyncio.StreamWriter] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self._closed = False
+        # set and replaced every time the status changes, so waiting on it wakes up on the next change
+        self._status_changed = asyncio.Event()
+        self._listener = server.add_event_listener(self._on_status_event, GameServerEventType.STATUS)
+
+    async def start(self):
+        self._listening = await asyncio.start_server(self._on_connect, port=self.port)
+
+    async def close(self):
+        self._closed = True
+        self._listener.deregister()
+        if self._listening is not None:
+            self._listening.close()
+        # closing the listener leaves the connections open, so close them and wake up the ones waiting for the server to start
+        for writer in self._writers:
+            writer.close()
+        self._status_changed.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def is_idle(self):
+        return (self.server.status == GameServerStatus.RUNNING and self.connections == 0
+                and time.monotonic() - self.last_active > self.server.hibernate_idle_timeout)
+
+    def _on_status_event(self, event: StatusEvent):
+        # emitted on whatever thread changed the status
+        self.hibernator.loop.call_soon_threadsafe(self._on_status, event.status)
+
+    def _on_status(self, status: GameServerStatus):
+        self.status = status
+        if status == GameServerStatus.RUNNING:
+            # a server that was just started gets the whole timeout before it counts as idle
+            self.last_active = time.monotonic()
+        self._status_changed.set()
+        self._status_changed = asyncio.Event()
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._writers.add(writer)
+        self._tasks.add(asyncio.current_task())
+        try:
+            if await self._wake():
+                await self._proxy(reader, writer)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.connections -= 1
+            self.last_active = time.monotonic()
+            self._writers.discard(writer)
+            self._tasks.discard(asyncio.current_task())
+            writer.close()
+
+    async def _wake(self):
+        """
+        Starts the server if it isn't running, and waits for it to be.
+
+        :return: True if it is running, False if it didn't start
+        """
+        deadline = time.monotonic() + self.hibernator.manager.config.start_slot_timeout
+        started = False
+        while self.status != GameServerStatus.RUNNING:
+            # a server in a crash loop has to be started by hand
+            if self._closed or self.status == GameServerStatus.CRASH_LOOP:
+                return False
+            if self.status == GameServerStatus.STOPPED:
+                if started:
+                    # it stopped again while starting
+                    return False
+                started = True
+                print(f"Waking up server {self.server.game}/{self.server.id}")
+                # starting blocks for a bit, so keep it off the event loop.
+                # the status events it emits are handled before this returns, so the status is already up to date after it
+                await asyncio.to_thread(self.server.start_server)
+                continue
+            try:
+                await asyncio.wait_for(self._status_changed.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def _proxy(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        deadline = time.monotonic() + self.CONNECT_RETRY_TIME
+        while True:
+            try:
+                server_reader, server_writer = await asyncio.open_connection("127.0.0.1", self.server_port)
+                break
+            except OSError:
+                if self._closed:
+                    return
+                if time.monotonic() > deadline or self.status != GameServerStatus.RUNNING:
+                    print(f"Couldn't connect to server {self.server.game}/{self.server.id} on port {self.server_port}")
+                    return
+                await asyncio.sleep(self.CONNECT_RETRY_INTERVAL)
+        if self._closed:
+            server_writer.close()
+            return
+        self._writers.add(server_writer)
+        try:
+            await asyncio.gather(self._pipe(reader, server_writer), self._pipe(server_reader, writer))
+        finally:
+            self._writers.discard(server_writer)
+            server_writer.close()
+
+    async def _pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while data := await reader.read(self.CHUNK_SIZE):
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            # let the other side know, while still passing on whatever comes back
+            if writer.can_write_eof() and not writer.is_closing():
+                try:
+                    writer.write_eof()
+                except OSError:
+                    pass
+
+class Hibernator:
+    """
+    Runs a `HibernationProxy` for every server with `hibernate` set, and stops those servers once they are idle.
+
+    The proxies are run by an asyncio event loop on its own thread. The servers are checked every `CHECK_INTERVAL` seconds,
+    which is also when proxies are added or removed for servers whose settings changed.
+    """
+    CHECK_INTERVAL = 10
+
+    def __init__(self, manager: 'ServerManager'):
+        self.manager = manager
+        self.loop = asyncio.new_event_loop()
+        self.proxies: dict[GameServer, HibernationProxy] = {}
+        self._task: asyncio.Future = None
+        self._thread = Thread(target=self.loop.run_forever, name="Hibernator", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._task = asyncio.run_coroutine_threadsafe(self._run(), self.loop)
+
+    def stop(self):
+        """
+        Closes every proxy, so connections no longer wake up servers, and stops the thread.
+        """
+        if not self._thread.is_alive():
+            return
+        self._task.cancel()
+        asyncio.run_coroutine_threadsafe(self._close_all(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.check()
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(self.CHECK_INTERVAL)
+
+    async def check(self):
+        """
+        Updates the proxies to match the settings of the servers, and stops servers that are idle.
+        """
+        servers = {server for server in list(self.manager.servers.values())
+                   if server.hibernate and server.hibernate_port is not None and server.hibernate_server_port is not None}
+        for server, proxy in list(self.proxies.items()):
+            if server not in servers or (server.hibernate_port, server.hibernate_server_port) != (proxy.port, proxy.server_port):
+                del self.proxies[server]
+                await proxy.close()
+        for server in servers:
+            if server in self.proxies:
+                continue
+            proxy = HibernationProxy(self, server)
+            try:
+                await proxy.start()
+            except OSError as e:
+                await proxy.close()
+                print(f"Couldn't listen on port {server.hibernate_port} for server {server.game}/{server.id}: {e}")
+                continue
+            self.proxies[server] = proxy
+
+        for server, proxy in self.proxies.items():
+            if proxy.is_idle():
+                print(f"Server {server.game}/{server.id} is idle, hibernating")
+                await asyncio.to_thread(server.stop_server)
+
+    async def _close_all(self):
+        for proxy in self.proxies.values():
+            await proxy.close()
+        self.proxies.clear()
@@ -1,16 +1,30 @@
+from threading import Event
+import time
 import traceback
 import yaml
 import importlib.util
 from pathlib import Path
 
 from app.management.config import Config, EnvConfig
-from app.management.metadata import MetadataFlags
+from app.management.admission import MemoryAdmission
+from app.management.events import GameServerEvent, GameServerEventDispatcher, GameServerEventType
+from app.management.hibernation import Hibernator
+from app.management.metadata import MetadataFlags, ValueMetadata
+from app.management.placement import Placer
 from app.management.storage import Directory, File, StorageManager
+from app.management.scheduler import StartupScheduler
 from app.management.server import GameServer, GameServerStatus
+from app.management.stats import StatsSampler
 from app.management.upgrades import upgrade
 
 class ServerManager:
     CLASSES = []
+    # seconds before the shutdown timeout to send SIGTERM to servers that still haven't stopped
+    SHUTDOWN_TERMINATE_GRACE = 10
+    # seconds to wait for killed servers to be cleaned up after the shutdown timeout
+    SHUTDOWN_KILL_WAIT = 5
+    # CLASSES keyed by class name, so they can be looked up quickly
+    _CLASS_INDEX: dict[str, type[GameServer]] = {}
 
     @staticmethod
     def import_classes_from_directory(directory: Directory, recursion_depth = 0):
@@ -58,13 +72,24 @@ class ServerManager:
     @classmethod
     def load_builtin_plugins(cls):
         cls.CLASSES = cls.import_classes_from_directory(Directory("plugins"))
+        cls.index_classes()
 
     @classmethod
-    def get_class(cls, class_name):
+    def index_classes(cls):
+        """
+        Rebuilds the class name index, and invalidates anything cached about the classes.
+        Needs to be called whenever `CLASSES` changes.
+        """
+        index = {}
         for class_ in cls.CLASSES:
-            if class_.__name__ == class_name:
-                return class_
-        return None
+            # the first class with a name wins, the same one a search through the list would find
+            index.setdefault(class_.__name__, class_)
+        cls._CLASS_INDEX = index
+        ValueMetadata.invalidate_schemas()
+
+    @classmethod
+    def get_class(cls, class_name):
+        return cls._CLASS_INDEX.get(class_name)
         
     def __init__(self, dir='.', storage_manager = None, ):
         self.dir = dir
@@ -78,16 +103,48 @@ class ServerManager:
         self.config = None
         self.should_save_config = True
         self.env_config = EnvConfig()
+        self.stats_sampler: StatsSampler = None
+        self.hibernator: Hibernator = None
+        self.startup_scheduler = StartupScheduler(self)
+        self._listeners = GameServerEventDispatcher()
+        self.admission = MemoryAdmission(self)
+        self.placer = Placer(self)
 
-        self.servers: list[GameServer] = []
+        # servers keyed by (game, id)
+        self.servers: dict[tuple[str, str], GameServer] = {}
 
         self.class_map: dict[str, type[GameServer]] = {}
+        # caches which class is used for a game, as resolving it has to check every prefix of the game
+        self._game_class_cache: dict[str, type[GameServer]] = {}
 
     def register_class(self, game, class_, force = False):
         if not force and game in self.class_map:
             # TODO choose better exceptions. do i need to make my own or is there a better builtin one?
             raise KeyError(f"Game {game} is already registered!")
         self.class_map[game] = class_
+        self._game_class_cache.clear()
+
+    def get_game_class(self, game: str):
+        """
+        Gets the class used for servers of `game`.
+        This is the class registered to the longest prefix of `game`, like "minecraft" for "minecraft/fabric".
+
+        :param game: The game to find the class for
+        :return: The class, or `GameServer` if there is no registered class
+        """
+        found_class = self._game_class_cache.get(game)
+        if found_class is not None:
+            return found_class
+        parts = game.split('/')
+        for i in range(len(parts), 0, -1):
+            current_search = '/'.join(parts[:i])
+            if current_search in self.class_map:
+                found_class = self.class_map[current_search]
+                break
+        else:
+            found_class = GameServer
+        self._game_class_cache[game] = found_class
+        return found_class
 
     def create_server(self, game, id, **kwargs):
         """
@@ -114,38 +171,163 @@ class ServerManager:
         Params are the same as the `GameServer` class.
         :return: The created server object.
         """
-        parts = game.split('/')
-        for i in range(len(parts), 0, -1):
-            current_search = '/'.join(parts[:i])
-            if current_search in self.class_map:
-                found_class = self.class_map[current_search]
-                break
-        else:
-            found_class = GameServer
-        server = found_class(self.storage_manager, **kwargs, game=game)
-        self.servers.append(server)
+        server = self.get_game_class(game)(self.storage_manager, **kwargs, game=game)
+        server.add_event_listener(self._forward_event)
+        server.admission = self.admission
+        server.placer = self.placer
+        self.servers[(server.game, server.id)] = server
         return server
 
+    def add_event_listener(self, func, filter = None):
+        """
+        Listens to events from every server, including ones created later.
+        The server that emitted an event is stored in `event.server`.
+        """
+        return self._listeners.add(func, filter)
+
+    def _forward_event(self, event: GameServerEvent):
+        self._listeners.dispatch(event)
+
+    def remove_server(self, server: GameServer):
+        """
+        Removes a server from the manager. Its files are left alone.
+
+        :raises KeyError: If the server isn't managed by this manager
+        """
+        if self.servers.get((server.game, server.id)) is not server:
+            raise KeyError(f"Server {server.id} of type {server.game} doesn't exist!")
+        del self.servers[(server.game, server.id)]
+
+    def update_server(self, server: GameServer, data: dict):
+        """
+        Updates the settings of a server, see `GameServer.update_from_dict()`.
+        This should be used instead of updating the server directly, as the server needs to be reindexed if its game or id changes.
+
+        :return: The keys that couldn't be set
+        """
+        key = (server.game, server.id)
+        failed_keys = server.update_from_dict(data)
+        new_key = (server.game, server.id)
+        if new_key != key:
+            if new_key in self.servers:
+                # put it back the way it was instead of replacing a different server
+                server.game, server.id = key
+                return failed_keys + [k for k in ("game", "id") if k in data]
+            del self.servers[key]
+            self.servers[new_key] = server
+        return failed_keys
+
     def auto_start_servers(self):
-        for server in self.servers:
-            if server.auto_start:
-                server.start_server()
-
-    def wait_for_shutdown(self):
-        # iterate once to send shutdown signals, than iterate again to actually wait.
-        # this way we don't end up waiting for a server to shutdown before starting the shutdown on the next one
-        for server in self.servers:
-            if server.status not in (GameServerStatus.STOPPED, GameServerStatus.STOPPING):
-                server.stop_server()
-        for server in self.servers:
-            if server.process is not None:
-                server.process.wait()
+        """
+        Starts every server that is set to auto start, a few at a time, see `StartupScheduler`.
+        This doesn't wait for them to start.
+        """
+        self.startup_scheduler.schedule([server for server in self.servers.values() if server.auto_start])
+
+    def start_stats_sampler(self):
+        """
+        Starts sampling resource usage of running servers in the background, at the interval set in the config.
+        """
+        self.stats_sampler = StatsSampler(self, self.config.stats_interval)
+        self.stats_sampler.start()
+
+    def stop_stats_sampler(self):
+        if self.stats_sampler is not None:
+            self.stats_sampler.stop()
+            self.stats_sampler = None
+
+    def start_hibernator(self):
+        """
+        Starts listening for connections to hibernating servers, and stopping them when they are idle, see `Hibernator`.
+        """
+        self.hibernator = Hibernator(self)
+        self.hibernator.start()
+
+    def stop_hibernator(self):
+        if self.hibernator is not None:
+            self.hibernator.stop()
+            self.hibernator = None
+
+    def wait_for_shutdown(self, timeout: float = None):
+        """
+        Stops every server at the same time and waits for them to stop, so shutting down takes as long as the slowest server.
+
+        Servers get their stop command first. Any that are still running `SHUTDOWN_TERMINATE_GRACE` seconds
+        before the timeout get SIGTERM, and any still running at the timeout get SIGKILL.
+        Their own `stop_timeout` is ignored, so none of them are killed before they got SIGTERM.
+        Servers running under a shim are left running, see `GameServer.detach`.
+
+        :param timeout: Max amount of seconds to wait, defaults to None meaning use `shutdown_timeout` from the config
+        :return: A dict with an entry for each server that was running, keyed by "game/id",
+                 with how many `seconds` it took to stop, its `returncode`, and the last `escalation` step it got,
+                 which is one of "stop", "terminate" or "kill". `seconds` is None if it didn't stop.
+        """
+        timeout = self.config.shutdown_timeout if timeout is None else timeout
+        # servers still waiting to be auto started shouldn't start now
+        self.startup_scheduler.cancel()
+        # and neither should servers waiting for memory
+        for server in self.admission.get_queue():
+            server.stop_server()
+        start = time.monotonic()
+        terminate_at = start + max(timeout - self.SHUTDOWN_TERMINATE_GRACE, 0)
+        kill_at = start + timeout
+
+        stopped = Event()
+        listener = self.add_event_listener(lambda event: stopped.set(), GameServerEventType.STATUS)
+        try:
+            for server in self.servers.values():
+                # crashed servers waiting to be restarted shouldn't start now either
+                server.cancel_restart()
+            # detached servers keep running, and the next manager attaches to them again
+            running = {server for server in self.servers.values() if not server.is_stopped() and not server.is_detached()}
+            results = {f"{server.game}/{server.id}": {"seconds": None, "returncode": None, "escalation": "stop"} for server in running}
+            # send every stop command before waiting on any of them.
+            # killing them is left to the steps below, even for servers that were already stopping
+            for server in running:
+                if server.status == GameServerStatus.STOPPING:
+                    server.cancel_kill()
+                else:
+                    server.stop_server(kill_after_timeout=False)
+
+            escalation = "stop"
+            while running:
+                now = time.monotonic()
+                for server in [server for server in running if server.is_stopped()]:
+                    running.remove(server)
+                    results[f"{server.game}/{server.id}"] |= {"seconds": now - start, "returncode": server.process.returncode if server.process is not None else None}
+                if not running:
+                    break
+
+                if escalation == "stop" and now >= terminate_at:
+                    escalation = "terminate"
+                    for server in running:
+                        # a detached server still being started has no process yet, and is stopped once it has one
+                        if server.process is not None:
+                            server.process.terminate()
+                elif escalation == "terminate" and now >= kill_at:
+                    escalation = "kill"
+                    for server in running:
+                        if server.process is not None:
+                            server.process.kill()
+                elif escalation == "kill" and now >= kill_at + self.SHUTDOWN_KILL_WAIT:
+                    break
+                for server in running:
+                    results[f"{server.game}/{server.id}"]["escalation"] = escalation
+
+                # wake up when any server changes status, or when it is time for the next step
+                next_step = {"stop": terminate_at, "terminate": kill_at, "kill": kill_at + self.SHUTDOWN_KILL_WAIT}[escalation]
+                stopped.wait(max(next_step - time.monotonic(), 0))
+                stopped.clear()
+        finally:
+            listener.deregister()
+        # detached servers keep running, so nothing ends their log sessions. what is buffered would be lost,
+        # and the next manager fills their consoles from the logs
+        for server in self.servers.values():
+            server.console.log.flush()
+        return results
     
     def get_server(self, game, id):
-        for server in self.servers:
-            if server.game == game and server.id == id:
-                return server
-        return None # technically None could be returned implicitly but i added this for readablity
+        return self.servers.get((game, id))
 
     def load_settings(self):
         if self.settings_yaml.exists():
@@ -174,6 +356,7 @@ class ServerManager:
 
         # TODO move this to Config class so there isn't any confusion over Manager.class_map and Config.class_map
         self.class_map.clear()
+        self._game_class_cache.clear()
         for game, class_ in self.config.class_map.items():
             self.register_class(game, self.get_class(class_), True)
 
@@ -189,6 +372,9 @@ class ServerManager:
             self.reload_servers()
         else:
             pass # no extra setup is required if there is no file
+        for server in self.servers.values():
+            if server.reattach():
+                print(f"Reattached to server {server.game}/{server.id}")
 
     def reload_servers(self):
         self.servers.clear()
@@ -203,10 +389,11 @@ class ServerManager:
     def save_servers(self):
         self.servers_yaml.ensure_parent_exists()
         with self.servers_yaml.open("w") as file:
-            yaml.safe_dump([s.as_dict(flat=True, filter=MetadataFlags.SETTINGS) for s in self.servers], file, sort_keys=False)
+            yaml.safe_dump([s.as_dict(flat=True, filter=MetadataFlags.SETTINGS) for s in self.servers.values()], file, sort_keys=False)
 
     def load_plugins(self):
         plugins_dir = self.storage_manager.base_dir.get_directory("plugins")
         plugins_dir.ensure_exists()
         # TODO improve the way plugins are loaded so that they can do more than just provide server types
         self.CLASSES += self.import_classes_from_directory(plugins_dir)
+        self.index_classes()
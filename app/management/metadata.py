@@ -52,44 +52,74 @@ class ValueMetadata:
     def is_metadata(annotation):
         return get_origin(annotation) is Annotated and type(annotation.__metadata__[0]) is ValueMetadata
     
+    # bumped to invalidate the schemas cached on every class
+    _schema_generation = 0
+
     @staticmethod
-    def iter_metadatas(obj: object, get_values = True, include_duplicates = False, filter = None):
-        # TODO how should conflicting 
-        found_fields = {}
+    def invalidate_schemas():
+        """
+        Invalidates the cached schema of every class, so they are rebuilt the next time they're used.
+        Should be called whenever plugins are reloaded, as classes might have changed.
+        """
+        ValueMetadata._schema_generation += 1
+
+    @staticmethod
+    def get_schema(cls: type):
+        """
+        Gets the fields with metadata on `cls`, building it the first time it is needed.
 
-        for cls in obj.__class__.__mro__:
-            if not hasattr(cls, "__annotations__"):
+        The schema is cached on the class itself, so walking the MRO and getting annotations only happens once per class.
+        Each entry is a tuple of `(name, metadata, defining class, getter)`,
+        where getter is the method that gets the value or None if it is an attribute.
+        Fields overridden by a subclass show up once for each class that defines them, subclasses first.
+
+        :param cls: The class to get the schema of
+        :return: A tuple of entries, in the same order `iter_metadatas()` yields them
+        """
+        # use __dict__ so a subclass doesn't find the schema cached on its parent
+        cached = cls.__dict__.get("_metadata_schema")
+        if cached is not None and cached[0] == ValueMetadata._schema_generation:
+            return cached[1]
+        schema = tuple(ValueMetadata._build_schema(cls))
+        cls._metadata_schema = (ValueMetadata._schema_generation, schema)
+        return schema
+
+    @staticmethod
+    def _build_schema(cls: type):
+        for defining_cls in cls.__mro__:
+            if not hasattr(defining_cls, "__annotations__"):
                 continue
 
-            for var_name, annotation in inspect.get_annotations(cls).items():
+            for var_name, annotation in inspect.get_annotations(defining_cls).items():
                 if not ValueMetadata.is_metadata(annotation):
                     continue
-                metadata: ValueMetadata = annotation.__metadata__[0]
-                if filter and not filter(metadata):
-                    continue
-                value = metadata.get_value(getattr(obj, var_name)) if get_values else None
-                if (not include_duplicates) and var_name in found_fields:
-                    continue
-                found_fields[var_name] = cls
-                yield var_name, value, metadata, cls
+                yield var_name, annotation.__metadata__[0], defining_cls, None
 
-            for method_name, method in cls.__dict__.items():
+            for method_name, method in defining_cls.__dict__.items():
                 if not callable(method):
                     continue
-                annotations = inspect.get_annotations(method)
-                if 'return' not in annotations or not ValueMetadata.is_metadata(annotation):
-                    continue
-                annotation = annotations['return']
-                metadata: ValueMetadata = annotation.__metadata__[0]
-                if filter and not filter(metadata):
+                annotation = inspect.get_annotations(method).get('return')
+                if annotation is None or not ValueMetadata.is_metadata(annotation):
                     continue
-                if method_name.startswith("get_"):
-                    method_name = method_name[4:]
-                if (not include_duplicates) and method_name in found_fields:
-                    continue
-                found_fields[method_name] = cls
-                value = metadata.get_value(method(obj)) if get_values else None
-                yield method_name, value, metadata, cls
+                name = method_name[4:] if method_name.startswith("get_") else method_name
+                yield name, annotation.__metadata__[0], defining_cls, method
+
+    @staticmethod
+    def iter_metadatas(obj: object, get_values = True, include_duplicates = False, filter = None):
+        found_fields = set()
+        for name, metadata, cls, getter in ValueMetadata.get_schema(obj.__class__):
+            # filter first, so if a subclass overrides a field with different flags
+            # the closest definition that passes the filter is used
+            if filter and not filter(metadata):
+                continue
+            if name in found_fields and not include_duplicates:
+                continue
+            found_fields.add(name)
+            if get_values:
+                value = metadata.get_value(getter(obj) if getter is not None else getattr(obj, name))
+            else:
+                value = None
+            yield name, value, metadata, cls
 
 
 
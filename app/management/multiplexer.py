@@ -0,0 +1,414 @@
+import codecs
+from collections import deque
+from concurrent.futures import Future
+import heapq
+import itertools
+import os
+import selectors
+import socket
+import subprocess
+import traceback
+from queue import SimpleQueue
+from threading import Lock, Thread, get_ident
+import time
+from typing import Callable
+
+from app import utils
+
+def _set_future_result(future: Future):
+    # the caller might have cancelled it
+    if not future.done():
+        future.set_result(None)
+
+def _set_future_exception(future: Future, exception: BaseException):
+    if not future.done():
+        future.set_exception(exception)
+
+class TimerHandle:
+    """Returned by `ProcessMultiplexer.call_later()`, can be used to cancel the call."""
+    def __init__(self, when: float, func: Callable, args: tuple):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class _OutputStream:
+    """
+    Reads one output pipe of a process and splits it into lines incrementally.
+    """
+    def __init__(self, watched: '_WatchedProcess', file, error: bool):
+        self.watched = watched
+        self.file = file
+        self.fd = file.fileno()
+        self.error = error
+        self.decoder = codecs.getincrementaldecoder("utf8")(errors="replace")
+        self.partial_line = ""
+
+    def feed(self, data: bytes, final = False):
+        text = self.partial_line + self.decoder.decode(data, final)
+        lines = text.split("\n")
+        self.partial_line = lines.pop()
+        lines = [line + "\n" for line in lines]
+        if final and self.partial_line:
+            # a program can exit without ending its last line, it should still show up
+            lines.append(self.partial_line)
+            self.partial_line = ""
+        if lines:
+            self.watched.on_lines(lines, self.error)
+
+class _InputStream:
+    """
+    Data waiting to be written to the stdin of a process.
+
+    Everything that is queued is kept in one buffer, so commands queued close together are still written with one syscall.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.fd = file.fileno()
+        self.buffer = bytearray()
+        # futures of queued writes, with the amount of bytes that have to be written in total for each one to be done
+        self.pending: deque[tuple[int, Future]] = deque()
+        self.queued = 0
+        self.written = 0
+        # whether the pipe was full and the selector is waiting for it to have room
+        self.waiting = False
+        self.closed = False
+        # only used on Windows, where writes are done on their own thread
+        self.queue: SimpleQueue = SimpleQueue()
+
+class _WatchedProcess:
+    def __init__(self, process: subprocess.Popen, on_line: Callable[[str, bool], None], on_exit: Callable[[int], None]):
+        self.process = process
+        self.on_line = on_line
+        self.on_exit = on_exit
+        self.streams = [_OutputStream(self, file, file is process.stderr) for file in (process.stdout, process.stderr) if file is not None]
+        self.stdin = _InputStream(process.stdin) if process.stdin is not None else None
+        self.pidfd = None
+        # for processes that say when they exit through a file descriptor, see `ProcessMultiplexer.add_process()`
+        self.exit_fd = None
+        self.exited = False
+
+    def on_lines(self, lines: list[str], error: bool):
+        for line in lines:
+            self.on_line(line, error)
+
+class ProcessMultiplexer:
+    """
+    Watches the output and exit of every managed process from a single thread.
+
+    Output pipes are made non-blocking and read in large chunks whenever the selector says they are readable,
+    then split into lines as the data comes in. On Linux, the exit of a process is detected through a pidfd,
+    so the amount of threads stays the same no matter how many servers are running.
+
+    Input is queued with `write()` and written without blocking as the process reads it,
+    so a process that stops reading its input can't hold up whoever is sending it commands.
+
+    Callbacks are always run on the multiplexer thread, so they should be quick,
+    as a slow callback will delay the output of every other process.
+    Anything that needs to touch the selector is also done on that thread, through `call_soon()`.
+
+    Windows can't use pipes with selectors, so it falls back to a thread per pipe for reading output and writing input.
+    """
+    # amount of bytes to read from a pipe at a time
+    CHUNK_SIZE = 64 * 1024
+    # how often to check if a process has exited, when there isn't a way to get notified about it
+    EXIT_POLL_INTERVAL = 1
+    # how long to keep reading output after a process exits, before giving up on its pipes closing
+    PIPE_CLOSE_GRACE = 5
+
+    _instance: 'ProcessMultiplexer' = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def get(cls):
+        """
+        Gets the shared multiplexer, starting it if needed.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # a socket pair works with selectors on every platform, unlike a pipe
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._wakeup_read.setblocking(False)
+        self._wakeup_write.setblocking(False)
+        self.selector.register(self._wakeup_read, selectors.EVENT_READ, self._on_wakeup)
+
+        self._lock = Lock()
+        self._pending: list[tuple[Callable, tuple]] = []
+        # watched processes that haven't exited yet, so input can be written to them
+        self._processes: dict[subprocess.Popen, _WatchedProcess] = {}
+        self._timers: list[tuple[float, int, TimerHandle]] = []
+        self._timer_counter = itertools.count()
+        self._thread = Thread(target=self._run, name="ProcessMultiplexer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def in_thread(self):
+        """Checks if this is being called from the multiplexer thread."""
+        return get_ident() == self._thread.ident
+
+    def call_soon(self, func: Callable, *args):
+        """
+        Runs `func` on the multiplexer thread as soon as possible. Safe to call from any thread.
+        """
+        with self._lock:
+            self._pending.append((func, args))
+        self._wakeup()
+
+    def call_later(self, delay: float, func: Callable, *args):
+        """
+        Runs `func` on the multiplexer thread after `delay` seconds. Safe to call from any thread.
+
+        :return: A handle that can cancel the call
+        """
+        handle = TimerHandle(time.monotonic() + delay, func, args)
+        with self._lock:
+            heapq.heappush(self._timers, (handle.when, next(self._timer_counter), handle))
+        self._wakeup()
+        return handle
+
+    def add_process(self, process: subprocess.Popen, on_line: Callable[[str, bool], None], on_exit: Callable[[int], None]):
+        """
+        Starts watching a process.
+
+        `on_exit` is only called once the process has exited and all of its output has been passed to `on_line`.
+
+        Processes that aren't children of this one, like servers run under a shim, can't be waited on.
+        Those can have an `exit_fileno()` method instead, returning a file descriptor that becomes readable once they exit.
+
+        :param process: The process to watch, its stdout and stderr should be pipes
+        :param on_line: Called with every line of output and a bool that is True if the line came from stderr
+        :param on_exit: Called with the return code after the process exits
+        """
+        watched = _WatchedProcess(process, on_line, on_exit)
+        with self._lock:
+            self._processes[process] = watched
+        self.call_soon(self._register, watched)
+        if utils.is_windows:
+            for stream in watched.streams:
+                Thread(target=self._read_blocking, args=(stream,), daemon=True).start()
+            if watched.stdin is not None:
+                Thread(target=self._write_blocking, args=(watched.stdin,), daemon=True).start()
+
+    def write(self, process: subprocess.Popen, data: bytes):
+        """
+        Queues `data` to be written to the stdin of a watched process. Safe to call from any thread.
+        Writes happen in the order they were queued, and never block the caller.
+
+        :return: A future that is done once all of `data` was written, or fails with an `OSError` if it can't be written
+        """
+        future = Future()
+        with self._lock:
+            watched = self._processes.get(process)
+        if watched is None or watched.stdin is None:
+            future.set_exception(BrokenPipeError("The process has exited or has no stdin"))
+        elif utils.is_windows:
+            watched.stdin.queue.put((data, future))
+        else:
+            self.call_soon(self._queue_write, watched.stdin, data, future)
+        return future
+
+    def _register(self, watched: _WatchedProcess):
+        if not utils.is_windows:
+            for stream in watched.streams:
+                os.set_blocking(stream.fd, False)
+                self.selector.register(stream.fd, selectors.EVENT_READ, lambda mask, stream=stream: self._on_readable(stream))
+            if watched.stdin is not None:
+                os.set_blocking(watched.stdin.fd, False)
+        exit_fileno = getattr(watched.process, "exit_fileno", None)
+        if exit_fileno is not None:
+            watched.exit_fd = exit_fileno()
+            self.selector.register(watched.exit_fd, selectors.EVENT_READ, lambda mask: self._check_exit(watched))
+            return
+        try:
+            watched.pidfd = os.pidfd_open(watched.process.pid)
+        except (AttributeError, OSError):
+            # no pidfd support, so fall back to polling
+            self.call_later(self.EXIT_POLL_INTERVAL, self._poll_exit, watched)
+        else:
+            self.selector.register(watched.pidfd, selectors.EVENT_READ, lambda mask: self._check_exit(watched))
+
+    def _on_readable(self, stream: _OutputStream):
+        try:
+            data = os.read(stream.fd, self.CHUNK_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if data:
+            stream.feed(data)
+            return
+        # an empty read means eof
+        self.selector.unregister(stream.fd)
+        self._close_stream(stream)
+
+    def _read_blocking(self, stream: _OutputStream):
+        """Reads a pipe until eof on its own thread, only used on Windows"""
+        while data := stream.file.read1(self.CHUNK_SIZE):
+            self.call_soon(stream.feed, data)
+        self.call_soon(self._close_stream, stream)
+
+    def _queue_write(self, stream: _InputStream, data: bytes, future: Future):
+        if stream.closed:
+            future.set_exception(BrokenPipeError("The process has exited"))
+            return
+        if not data:
+            # nothing would ever get written to finish it
+            future.set_result(None)
+            return
+        stream.buffer += data
+        stream.queued += len(data)
+        stream.pending.append((stream.queued, future))
+        # if it is waiting, the selector will flush it once the pipe has room
+        if not stream.waiting:
+            self._flush_input(stream)
+
+    def _flush_input(self, stream: _InputStream):
+        while stream.buffer:
+            try:
+                written = os.write(stream.fd, stream.buffer)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                self._close_input(stream, e)
+                return
+            del stream.buffer[:written]
+            stream.written += written
+            while stream.pending and stream.pending[0][0] <= stream.written:
+                _set_future_result(stream.pending.popleft()[1])
+        # the process isn't reading fast enough, so wait for its pipe to have room
+        if stream.buffer and not stream.waiting:
+            self.selector.register(stream.fd, selectors.EVENT_WRITE, lambda mask: self._flush_input(stream))
+            stream.waiting = True
+        elif not stream.buffer and stream.waiting:
+            self.selector.unregister(stream.fd)
+            stream.waiting = False
+
+    def _write_blocking(self, stream: _InputStream):
+        """Writes queued input on its own thread, only used on Windows"""
+        while (item := stream.queue.get()) is not None:
+            data, future = item
+            try:
+                stream.file.write(data)
+                stream.file.flush()
+            except OSError as e:
+                _set_future_exception(future, e)
+            else:
+                _set_future_result(future)
+
+    def _close_input(self, stream: _InputStream, error: OSError = None):
+        """Fails every write that is still queued, and stops accepting new ones"""
+        if stream.closed:
+            return
+        stream.closed = True
+        if stream.waiting:
+            self.selector.unregister(stream.fd)
+            stream.waiting = False
+        stream.buffer.clear()
+        while stream.pending:
+            _set_future_exception(stream.pending.popleft()[1], error or BrokenPipeError("The process has exited"))
+        stream.queue.put(None)
+        try:
+            stream.file.close()
+        except OSError:
+            pass
+
+    def _close_stream(self, stream: _OutputStream):
+        stream.feed(b"", final=True)
+        stream.file.close()
+        stream.watched.streams.remove(stream)
+        self._check_exit(stream.watched)
+
+    def _force_close_streams(self, watched: _WatchedProcess):
+        """
+        Stops waiting for output from a process that has already exited.
+        Needed when something else, like a child of the process, is still holding the pipes open.
+        """
+        for stream in list(watched.streams):
+            self.selector.unregister(stream.fd)
+            self._close_stream(stream)
+
+    def _poll_exit(self, watched: _WatchedProcess):
+        if not self._check_exit(watched):
+            self.call_later(self.EXIT_POLL_INTERVAL, self._poll_exit, watched)
+
+    def _check_exit(self, watched: _WatchedProcess):
+        """
+        Calls the exit callback if the process has exited and all output has been read.
+
+        :return: True if the process has exited
+        """
+        if watched.exited:
+            return True
+        if watched.process.poll() is None:
+            return False
+        if watched.pidfd is not None:
+            self.selector.unregister(watched.pidfd)
+            os.close(watched.pidfd)
+            watched.pidfd = None
+        if watched.exit_fd is not None:
+            self.selector.unregister(watched.exit_fd)
+            watched.exit_fd = None
+        with self._lock:
+            self._processes.pop(watched.process, None)
+        if watched.stdin is not None:
+            self._close_input(watched.stdin)
+        # wait for the pipes to close so no output gets lost,
+        # this will get called again when the last one does
+        if watched.streams:
+            if not utils.is_windows:
+                self.call_later(self.PIPE_CLOSE_GRACE, self._force_close_streams, watched)
+            return True
+        watched.exited = True
+        watched.on_exit(watched.process.returncode)
+        return True
+
+    def _wakeup(self):
+        try:
+            self._wakeup_write.send(b"\0")
+        except BlockingIOError:
+            # the socket is full, so the thread is going to wake up anyway
+            pass
+
+    def _on_wakeup(self, mask):
+        try:
+            while self._wakeup_read.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _run(self):
+        while True:
+            with self._lock:
+                timeout = max(self._timers[0][0] - time.monotonic(), 0) if self._timers else None
+            for key, mask in self.selector.select(timeout):
+                self._run_callback(key.data, mask)
+
+            now = time.monotonic()
+            with self._lock:
+                due = []
+                while self._timers and self._timers[0][0] <= now:
+                    due.append(heapq.heappop(self._timers)[2])
+                pending = self._pending
+                self._pending = []
+            for handle in due:
+                if not handle.cancelled:
+                    self._run_callback(handle.func, *handle.args)
+            for func, args in pending:
+                self._run_callback(func, *args)
+
+    def _run_callback(self, func: Callable, *args):
+        # one broken callback shouldn't stop the output of every other server
+        try:
+            func(*args)
+        except Exception:
+            traceback.print_exc()
@@ -0,0 +1,266 @@
+from collections import Counter
+import errno
+import glob
+import os
+import re
+import shutil
+
+from app import utils
+
+# the class numbers used by the kernel and `ionice -c`
+IONICE_CLASSES = {
+    "realtime": 1,
+    "best-effort": 2,
+    "idle": 3,
+}
+
+def parse_cpu_list(text: str):
+    """
+    Parses a list of cpus in the format used by `taskset -c` and the kernel, like "0-3,6".
+
+    :raises ValueError: If `text` isn't a valid cpu list
+    """
+    cpus = set()
+    for part in text.replace(" ", "").split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+def format_cpu_list(cpus: set[int]):
+    """
+    The opposite of `parse_cpu_list()`.
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
+
+def parse_ionice(text: str):
+    """
+    Parses an io priority like "idle", "best-effort" or "best-effort:4", the number being 0 to 7 with 0 as the highest.
+
+    :raises ValueError: If `text` isn't a valid io priority
+    :return: The io class and the priority within it, None for the default priority
+    """
+    name, _, value = text.partition(":")
+    ioclass = IONICE_CLASSES.get(name.strip())
+    if ioclass is None:
+        raise ValueError(f"Unknown io class {name!r}, should be one of {', '.join(IONICE_CLASSES)}")
+    priority = int(value) if value else None
+    if priority is not None and not 0 <= priority <= 7:
+        raise ValueError(f"Io priority {priority} should be from 0 to 7")
+    return ioclass, priority
+
+def format_ionice(ionice: tuple[int, int | None]):
+    """
+    The opposite of `parse_ionice()`.
+    """
+    ioclass, priority = ionice
+    name = next(name for name, value in IONICE_CLASSES.items() if value == ioclass)
+    return name if priority is None else f"{name}:{priority}"
+
+class Placement:
+    """
+    Where a server process runs: the cpus it can use, its nice level and io priority, and the cgroup it is in.
+    Applied to the new process before it runs the server, so anything it starts gets the same placement.
+    """
+    def __init__(self, cpus: set[int] = None, nice: int = None, ionice: tuple[int, int | None] = None, cgroup: str = None):
+        self.cpus = cpus
+        self.nice = nice
+        self.ionice = ionice
+        self.cgroup = cgroup
+        # worked out now, as `apply()` shouldn't do more than it has to
+        self._cgroup_procs = os.path.join(cgroup, "cgroup.procs") if cgroup is not None else None
+
+    def apply(self):
+        """
+        Applies the cpus, nice level and cgroup to the current process, used as the `preexec_fn` of `subprocess.Popen`.
+
+        This runs in the forked child of a process with other threads, where anything that takes a lock can hang forever,
+        so it only makes `os` calls with arguments worked out beforehand. A setting that can't be applied,
+        like a negative nice level without the permissions for it, is reported on stderr,
+        which ends up in the server's console, and the server is still started.
+        The io priority can't be set with just `os`, so it is set by `wrap_command()` instead.
+        """
+        if self._cgroup_procs is not None:
+            self._try(b"Couldn't move to cgroup: ", self._join_cgroup, self._cgroup_procs)
+        if self.cpus:
+            self._try(b"Couldn't set cpu affinity: ", os.sched_setaffinity, 0, self.cpus)
+        if self.nice is not None:
+            self._try(b"Couldn't set nice level: ", os.setpriority, os.PRIO_PROCESS, 0, self.nice)
+
+    def wrap_command(self, command: list[str]):
+        """
+        Runs `command` through `ionice` if there is an io priority, as it can't be set from `apply()`.
+        """
+        if self.ionice is None:
+            return command
+        if shutil.which("ionice") is None:
+            print("Couldn't set io priority, ionice isn't installed")
+            return command
+        ioclass, priority = self.ionice
+        # -t starts the server even if the priority can't be set, like realtime without the permissions for it
+        return ["ionice", "-t", "-c", str(ioclass), *(["-n", str(priority)] if priority is not None else []), "--", *command]
+
+    def as_dict(self):
+        return {
+            "cpus": format_cpu_list(self.cpus) if self.cpus else None,
+            "nice": self.nice,
+            "ionice": format_ionice(self.ionice) if self.ionice is not None else None,
+            "cgroup": self.cgroup,
+        }
+
+    @staticmethod
+    def _join_cgroup(path: str):
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            # 0 means the process doing the write
+            os.write(fd, b"0")
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _try(message: bytes, func, *args):
+        try:
+            func(*args)
+        except OSError as e:
+            os.write(2, message + (os.strerror(e.errno) if e.errno else "unknown error").encode() + b"\n")
+
+class Placer:
+    """
+    Works out the placement of each server when it starts, from its own settings and the manager's config.
+
+    Servers without a `cpu_set` are spread out when `auto_placement` is on: each one gets `placement_cpus_per_server` cpus
+    on the NUMA node with the fewest servers, picking the cpus that the fewest running servers are already using.
+    Keeping a server on one node means its memory stays close to the cpus using it.
+    """
+    def __init__(self, manager: 'ServerManager'):
+        self.manager = manager
+        self._nodes: list[set[int]] = None
+
+    def get_nodes(self):
+        """
+        Gets the cpus this process can use, grouped by NUMA node.
+        Systems without NUMA, or where it can't be read, are treated as a single node.
+        """
+        if self._nodes is None:
+            available = os.sched_getaffinity(0)
+            nodes = []
+            for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"), key=lambda path: int(re.search(r"node(\d+)", path)[1])):
+                try:
+                    with open(path) as file:
+                        cpus = parse_cpu_list(file.read()) & available
+                except (OSError, ValueError):
+                    continue
+                if cpus:
+                    nodes.append(cpus)
+            self._nodes = nodes or [available]
+        return self._nodes
+
+    @staticmethod
+    def validate(server: 'GameServer'):
+        """
+        Checks the placement settings of `server`, done before it is admitted so a bad setting doesn't take its turn.
+
+        :raises ValueError: If one of them is invalid
+        """
+        if server.cpu_set:
+            parse_cpu_list(server.cpu_set)
+        if server.ionice:
+            parse_ionice(server.ionice)
+        # `Placement.apply()` can only report OSErrors, anything else would stop the server from starting
+        if server.nice is not None and (not isinstance(server.nice, int) or isinstance(server.nice, bool)):
+            raise ValueError(f"nice should be a whole number, not {server.nice!r}")
+
+    def get_placement(self, server: 'GameServer'):
+        """
+        Gets the placement for `server` as it starts.
+
+        :raises ValueError: If one of the server's placement settings is invalid, see `validate()`
+        :return: The `Placement`, or None if there is nothing to apply
+        """
+        if utils.is_windows:
+            return None
+        if server.cpu_set:
+            cpus = parse_cpu_list(server.cpu_set)
+        elif self.manager.config.auto_placement:
+            cpus = self.place(server)
+        else:
+            cpus = None
+        ionice = parse_ionice(server.ionice) if server.ionice else None
+        cgroup = self.prepare_cgroup(server)
+        if not cpus and server.nice is None and ionice is None and cgroup is None:
+            return None
+        return Placement(cpus, server.nice, ionice, cgroup)
+
+    def place(self, server: 'GameServer'):
+        """
+        Picks the cpus for a server without a `cpu_set`, see the class docstring.
+        """
+        reserved = parse_cpu_list(self.manager.config.placement_reserved_cpus)
+        nodes = [cpus - reserved for cpus in self.get_nodes()]
+        nodes = [cpus for cpus in nodes if cpus]
+        if not nodes:
+            return None
+        # how many running servers are using each cpu
+        load = Counter()
+        servers_on_node = Counter()
+        for other in list(self.manager.servers.values()):
+            if other is server or other.is_stopped() or other.placement is None or not other.placement.cpus:
+                continue
+            load.update(other.placement.cpus)
+            for index, cpus in enumerate(nodes):
+                if other.placement.cpus & cpus:
+                    servers_on_node[index] += 1
+        # ties go to the node with the least load, then the first one
+        index = min(range(len(nodes)), key=lambda index: (servers_on_node[index], sum(load[cpu] for cpu in nodes[index]), index))
+        count = max(self.manager.config.placement_cpus_per_server, 1)
+        return set(sorted(nodes[index], key=lambda cpu: (load[cpu], cpu))[:count])
+
+    def prepare_cgroup(self, server: 'GameServer'):
+        """
+        Creates the cgroup for a server with cgroup limits, under `cgroup_root` from the config, and sets its limits.
+        It is removed by `remove_cgroup()` once the server exits.
+
+        :return: The path of the cgroup, or None if the server doesn't have any limits or there is no `cgroup_root`
+        """
+        root = self.manager.config.cgroup_root
+        if server.cgroup_cpu_max is None and server.cgroup_memory_max is None:
+            return None
+        if root is None:
+            print(f"Server {server.game}/{server.id} has cgroup limits, but there is no cgroup_root in the config to put it under")
+            return None
+        path = os.path.join(root, re.sub(r"[^\w.-]", "_", f"{server.game}-{server.id}"))
+        try:
+            # the controllers have to be turned on for the children of the root before its children can use them
+            with open(os.path.join(root, "cgroup.subtree_control"), "w") as file:
+                file.write("+cpu +memory")
+            os.makedirs(path, exist_ok=True)
+            for name, value in (("cpu.max", server.cgroup_cpu_max), ("memory.max", server.cgroup_memory_max)):
+                with open(os.path.join(path, name), "w") as file:
+                    file.write(value if value is not None else "max")
+        except OSError as e:
+            print(f"Couldn't set up cgroup {path} for server {server.game}/{server.id}: {e}")
+            return None
+        return path
+
+    def remove_cgroup(self, server: 'GameServer'):
+        """
+        Removes the cgroup `server` was started in, once it has exited.
+        """
+        if server.placement is None or server.placement.cgroup is None:
+            return
+        try:
+            os.rmdir(server.placement.cgroup)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            if e.errno == errno.EBUSY:
+                # something the server started is still running in it, it's reused the next time the server starts
+                return
+            print(f"Couldn't remove cgroup {server.placement.cgroup} of server {server.game}/{server.id}: {e}")
@@ -0,0 +1,88 @@
+from collections import deque
+import random
+import time
+
+class CrashRecord:
+    """
+    A crash of a server, and what was done about it.
+    """
+    def __init__(self, time: float, returncode: int, lines: list[str], restart_delay: float | None, crash_loop: bool):
+        self.time = time
+        self.returncode = returncode
+        # the last console lines before the crash, which usually say why it happened
+        self.lines = lines
+        # seconds until the server is restarted, None if it isn't
+        self.restart_delay = restart_delay
+        self.crash_loop = crash_loop
+
+    def as_dict(self):
+        return {
+            "time": self.time,
+            "returncode": self.returncode,
+            "lines": self.lines,
+            "restart_delay": self.restart_delay,
+            "crash_loop": self.crash_loop,
+        }
+
+class RestartPolicy:
+    """
+    Decides when a server that crashed is restarted.
+
+    Every crash within `restart_window` seconds doubles the delay before the next restart,
+    starting at `restart_backoff` and going up to `restart_backoff_max`.
+    The delay is moved a bit at random so servers that crashed together don't all restart together.
+    Once a server crashes more than `restart_max` times within the window it is in a crash loop,
+    and it isn't restarted again until someone starts it.
+    """
+    # amount of crashes to remember for each server
+    CRASH_HISTORY_SIZE = 20
+    # amount of console lines kept with each crash
+    CRASH_LINES = 50
+    # how far the delay can be moved either way, as a fraction of it
+    JITTER = 0.2
+    # doubling the delay more times than this goes past any sensible max, and too big a power of 2 doesn't fit in a float
+    MAX_DOUBLINGS = 32
+
+    def __init__(self, server: 'GameServer'):
+        self.server = server
+        self.crashes: deque[CrashRecord] = deque(maxlen=self.CRASH_HISTORY_SIZE)
+        # crashes before this time don't count towards the limit, see `reset()`
+        self._since = 0
+
+    def on_crash(self, returncode: int):
+        """
+        Records a crash of the server, with the last lines of its console.
+
+        :return: The `CrashRecord`, which says if and when the server should be restarted
+        """
+        now = time.time()
+        since = max(now - self.server.restart_window, self._since)
+        # including this one
+        recent = sum(1 for crash in self.crashes if crash.time > since) + 1
+        lines = self.server.console.tail(self.CRASH_LINES)
+
+        restart_delay = None
+        crash_loop = False
+        if self.server.restart_on_crash:
+            if recent > self.server.restart_max:
+                crash_loop = True
+            else:
+                restart_delay = self.get_delay(recent)
+        record = CrashRecord(now, returncode, lines, restart_delay, crash_loop)
+        self.crashes.append(record)
+        return record
+
+    def get_delay(self, crashes: int):
+        """
+        Gets the seconds to wait before restarting a server that crashed `crashes` times within the window.
+        """
+        doublings = min(crashes - 1, self.MAX_DOUBLINGS)
+        delay = min(self.server.restart_backoff * 2 ** doublings, self.server.restart_backoff_max)
+        return delay * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+
+    def reset(self):
+        """
+        Forgets about the crashes so far when counting towards the limit, used when a server is started by hand.
+        They are still kept in `crashes`.
+        """
+        self._since = time.time()
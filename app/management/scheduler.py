@@ -0,0 +1,118 @@
+from threading import Event, Lock
+import traceback
+
+from app.management.events import GameServerEventType, StatusEvent
+from app.management.multiplexer import ProcessMultiplexer, TimerHandle
+from app.management.server import GameServer, GameServerStatus
+
+class StartupScheduler:
+    """
+    Starts servers a few at a time, so starting many servers at once, like on boot,
+    doesn't have them all fighting over the cpu and disk and each taking longer than it would on its own.
+
+    A server holds a slot until it is done starting, which is when its start indicator sets it to `RUNNING`, or when it stops.
+    Servers without a start indicator are running as soon as they start, so they give their slot back right away.
+    A server that never finishes starting gives its slot back after `start_slot_timeout` from the config,
+    so it can't hold up the rest forever.
+    """
+    def __init__(self, manager: 'ServerManager'):
+        self.manager = manager
+        self._queue: list[GameServer] = []
+        self._starting: dict[GameServer, TimerHandle] = {}
+        self._lock = Lock()
+        self._listener = None
+        self._done = Event()
+        self._done.set()
+        # whether `_fill_slots()` is running, see there
+        self._filling = False
+
+    def schedule(self, servers: list[GameServer]):
+        """
+        Queues servers to be started, higher `start_priority` first.
+        Servers with the same priority are started in the order they were given.
+        """
+        with self._lock:
+            for server in servers:
+                if server not in self._queue and server not in self._starting:
+                    self._queue.append(server)
+            if not self._queue:
+                return
+            # sort is stable, so servers with the same priority keep their order
+            self._queue.sort(key=lambda server: -server.start_priority)
+            self._done.clear()
+            if self._listener is None:
+                self._listener = self.manager.add_event_listener(self._on_status, GameServerEventType.STATUS)
+        self._fill_slots()
+
+    def cancel(self):
+        """
+        Forgets every server that hasn't been started yet. Servers that are already starting keep starting.
+        """
+        with self._lock:
+            self._queue.clear()
+            for timer in self._starting.values():
+                timer.cancel()
+            self._starting.clear()
+            self._finish()
+
+    def wait(self, timeout: float = None):
+        """
+        Waits for every queued server to be done starting.
+
+        :return: True if they are, False if it timed out
+        """
+        return self._done.wait(timeout)
+
+    def _fill_slots(self):
+        with self._lock:
+            # a server without a start indicator is running before `start_server()` returns, and gives its slot back from in there.
+            # the loop that is already filling slots picks that up, instead of this recursing once for every server
+            if self._filling:
+                return
+            self._filling = True
+        while True:
+            with self._lock:
+                # checked and cleared together, so a slot given back on another thread is either seen here or fills itself
+                if not self._queue and not self._starting:
+                    self._filling = False
+                    self._finish()
+                    return
+                if not self._queue or len(self._starting) >= self.manager.config.max_concurrent_starts:
+                    self._filling = False
+                    return
+                server = self._queue.pop(0)
+                self._starting[server] = ProcessMultiplexer.get().call_later(self.manager.config.start_slot_timeout, self._on_timeout, server)
+            # started without holding the lock, as starting emits events that come back to `_on_status()`
+            try:
+                started = server.start_server()
+            except Exception:
+                started = False
+                print(f"Server {server.game}/{server.id} failed to start!")
+                traceback.print_exc()
+            # it was already running, or doesn't have a start indicator
+            if not started or server.status != GameServerStatus.STARTING:
+                self._release(server)
+
+    def _release(self, server: GameServer):
+        with self._lock:
+            timer = self._starting.pop(server, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _finish(self):
+        # called while holding the lock
+        if self._listener is not None:
+            self._listener.deregister()
+            self._listener = None
+        self._done.set()
+
+    def _on_status(self, event: StatusEvent):
+        if event.status not in (GameServerStatus.RUNNING, GameServerStatus.STOPPED, GameServerStatus.CRASH_LOOP) or event.server not in self._starting:
+            return
+        self._release(event.server)
+        self._fill_slots()
+
+    def _on_timeout(self, server: GameServer):
+        print(f"Server {server.game}/{server.id} is taking too long to start, starting the next server")
+        self._release(server)
+        self._fill_slots()
@@ -1,14 +1,20 @@
 import subprocess
+from threading import RLock, Thread
+import traceback
 import psutil
-from threading import Thread
 from typing import Annotated
 from enum import Enum, auto
-import datetime
 
 from app import utils
-from app.management.events import ConsoleClearEvent, ConsoleLineEvent, GameServerEvent, GameServerEventListener, GameServerEventType, StatusEvent
+from app.management.console import GameConsole, GameConsoleLine
+from app.management.events import ConsoleLineEvent, GameServerEvent, GameServerEventDispatcher, GameServerEventListener, GameServerEventLog, GameServerEventType, StatusEvent
 from app.management.metadata import MetadataFlags, Setting, ValueMetadata
+from app.management.multiplexer import ProcessMultiplexer, TimerHandle
+from app.management.restarts import RestartPolicy
+from app.management.shim import ShimProcess
+from app.management.stats import StatsHistory
 from app.management.storage import StorageManager
+from app.management.triggers import ConsoleTrigger, ConsoleTriggers
 
 # TODO this can support anything that is run through the command line,
 # should i be naming everything with "Game"? 
@@ -19,47 +25,10 @@ class GameServerStatus(Enum):
     STARTING = auto()
     RUNNING = auto()
     STOPPING = auto()
-
-class GameConsoleLine:
-    def __init__(self, line: str, error: bool = False, timestamp: datetime.datetime = None):
-        self.timestamp = timestamp or datetime.datetime.now(datetime.timezone.utc)
-        self.line = line
-        self.error = error
-
-    def as_dict(self):
-        return {
-            "line": self.line,
-            "error": self.error,
-            "timestamp": self.timestamp.isoformat(),
-        }
-
-class GameConsole:
-    def __init__(self, server: 'GameServer'):
-        self.lines: list[GameConsoleLine] = []
-        self.server = server
-
-    def add_line(self, line, error = False):
-        console_line = GameConsoleLine(line, error)
-        self.lines.append(console_line)
-        self.server.emit_event(ConsoleLineEvent(console_line))
-
-    def as_dict(self):
-        return {
-            "lines": [line.as_dict() for line in self.lines],
-        }
-    
-    def clear(self):
-        self.lines.clear()
-        self.server.emit_event(ConsoleClearEvent())
-
-    def get_str(self):
-        """
-        Concatenates all lines of output into one string.
-        """
-        return ''.join([line.line for line in self.lines])
-
-    def print(self):
-        print(self.get_str())
+    # crashed too many times in a row, so it won't be restarted until someone starts it
+    CRASH_LOOP = auto()
+    # waiting for enough memory to be free to start, see `MemoryAdmission`
+    QUEUED = auto()
 
 # TODO by directly subclassing GameServer, extra server types can completely override all behaviour
 # maybe change to use a class only used for storing data and providing extra callbacks, without overriding anything from this class
@@ -83,15 +52,62 @@ class GameServer:
 
     # whether or not this server should start as soon as soon as it is loaded
     auto_start: Setting[bool] = False
+    # servers with a higher priority are auto started first
+    start_priority: Setting[int] = 0
     # whether or not the server should attempt to automatically restart if it detects a crash
     restart_on_crash: Setting[bool] = True
+    # seconds to wait before restarting after a crash, doubled for every crash within restart_window seconds
+    # up to restart_backoff_max. more than restart_max crashes within the window means it's in a crash loop
+    restart_backoff: Setting[float] = 5
+    restart_backoff_max: Setting[float] = 300
+    restart_max: Setting[int] = 5
+    restart_window: Setting[float] = 600
+    # settings that are None by default have their type given, as it can't be told from the value.
+    # MiB of memory the server needs, it is only started if this much is free. see `MemoryAdmission`
+    memory_reservation: Annotated[int | None, ValueMetadata(MetadataFlags.SETTINGS | MetadataFlags.WRITABLE, type="int")] = None
+    # where the server runs. cpu_set is a list of cpus like "0-3,6", without one the manager can pick some, see `Placer`.
+    # ionice is "idle", "best-effort" or "realtime", optionally with a priority from 0 to 7 like "best-effort:4".
+    # the cgroup limits use the cgroup v2 formats, like "200000 100000" for 2 cpus worth of time and "4G" of memory,
+    # and need cgroup_root to be set in the config. none of these work on windows
+    cpu_set: Annotated[str | None, ValueMetadata(MetadataFlags.SETTINGS | MetadataFlags.WRITABLE, type="string")] = None
+    nice: Annotated[int | None, ValueMetadata(MetadataFlags.SETTINGS | MetadataFlags.WRITABLE, type="int")] = None
+    ionice: Annotated[str | None, ValueMetadata(MetadataFlags.SETTINGS | MetadataFlags.WRITABLE, type="string")] = None
+    cgroup_cpu_max: Annotated[str | None, ValueMetadata(MetadataFlags.SETTINGS | MetadataFlags.WRITABLE, type="string")] = None
+    cgroup_memory_max: Annotated[str | None, ValueMetadata(MetadataFlags.SETTINGS | MetadataFlags.WRITABLE, type="string")] = None
+    # whether the server keeps running when the manager stops, so a restarted manager can attach to it again.
+    # the server is run under a small shim process that owns its console, see `app.management.shim`. not supported on windows
+    detach: Setting[bool] = False
+    # stop the server when nobody has been connected for hibernate_idle_timeout seconds, and start it again when someone connects.
+    # the manager listens on hibernate_port and passes connections on to hibernate_server_port, which the server itself should use.
+    # only works for games that use TCP, see `HibernationProxy`
+    hibernate: Setting[bool] = False
+    hibernate_port: Annotated[int | None, ValueMetadata(MetadataFlags.SETTINGS | MetadataFlags.WRITABLE, type="int")] = None
+    hibernate_server_port: Annotated[int | None, ValueMetadata(MetadataFlags.SETTINGS | MetadataFlags.WRITABLE, type="int")] = None
+    hibernate_idle_timeout: Setting[float] = 600
     # amount of time in seconds that a process has to stop,
     # after this we will forcably kill it
     stop_timeout: Setting[float] = 30
 
+    # maximum amount of console lines and characters kept in memory, counting the text of each line and its JSON
+    console_max_lines: Setting[int] = 5000
+    console_max_size: Setting[int] = 1024 * 1024
+    # console output of every run is saved to log files, which are split up once they reach
+    # a size in bytes or an age in seconds. only the newest sessions are kept, always including the current one.
+    console_log_max_size: Setting[int] = 16 * 1024 * 1024
+    console_log_max_age: Setting[float] = 24 * 60 * 60
+    console_log_max_sessions: Setting[int] = 20
+    # console lines that come in within this many seconds of each other are sent to clients together,
+    # 0 sends every line on its own
+    console_batch_window: Setting[float] = 0.05
+
     # name of folders that hold other files and folders to be shared across server instances
     BINS = []
 
+    # amount of stats samples to keep for each server
+    STATS_HISTORY_SIZE = 720
+    # amount of events to keep for clients that reconnect, the console lines in them are also limited by console_max_lines
+    EVENT_LOG_SIZE = 1000
+
     def __init__(self, storage_manager: StorageManager, **kwargs):
         """
         Creates a new server object.
@@ -111,11 +127,26 @@ class GameServer:
         self.storage_manager = storage_manager
 
         self.process = None
-        self.psutil = None
+        self.ps = None
+        self.stats_history = StatsHistory(self.STATS_HISTORY_SIZE)
         self.status = GameServerStatus.STOPPED
         self.console = GameConsole(self)
-
-        self._listeners: list[GameServerEventListener] = []
+        self.triggers = ConsoleTriggers()
+        self._start_trigger: ConsoleTrigger = None
+        self.restart_policy = RestartPolicy(self)
+        self._restart_timer: TimerHandle = None
+        # kills the process if it doesn't stop within `stop_timeout`, see `stop_server()`
+        self._kill_timer: TimerHandle = None
+        # set by the manager
+        self.admission: MemoryAdmission = None
+        self.placer: Placer = None
+        # where the current process was started, see `Placer`
+        self.placement: Placement = None
+
+        self._listeners = GameServerEventDispatcher()
+        self.events = GameServerEventLog(self.EVENT_LOG_SIZE)
+        # events are numbered and dispatched together, so listeners always get them in order
+        self._emit_lock = RLock()
 
         extra_data = {}
         for key, value in kwargs.items():
@@ -167,41 +198,193 @@ class GameServer:
 
     def start_server(self):
         """
-        Spawns the server subprocess and run threads to monitor it.
+        Spawns the server subprocess and starts monitoring it.
         Returns True if the server started, False if it was already running.
+
+        A detached server started from the multiplexer thread, like by a trigger or a restart after a crash,
+        is started on its own thread, so this returns before its process exists.
         """
-        if self.status != GameServerStatus.STOPPED:
+        if not self.is_stopped():
             return False
-        self.status = GameServerStatus.STARTING if self.start_indicator is not None else GameServerStatus.RUNNING
-        self.process = subprocess.Popen(self.get_command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.get_directory().path)
-        self.ps = psutil.Process(self.process.pid)
+        self.cancel_restart()
+        if self.placer is not None:
+            # before it's admitted, so a server that can't start doesn't take its turn or keep others queued
+            self.placer.validate(self)
+        if self.admission is not None:
+            admission = self.admission.admit(self)
+            if admission == Admission.QUEUED:
+                if self.status != GameServerStatus.QUEUED:
+                    print(f"Not enough memory to start server {self.game}/{self.id}, it will start once there is")
+                    self.status = GameServerStatus.QUEUED
+                    self.emit_status_event()
+                return False
+            if admission == Admission.REFUSED:
+                print(f"Not enough memory to start server {self.game}/{self.id}")
+                return False
+        previous_status = self.status
+        try:
+            self.placement = self.placer.get_placement(self) if self.placer is not None else None
+            # applied in the new process before it runs the server
+            preexec_fn = self.placement.apply if self.placement is not None else None
+            if self.status == GameServerStatus.CRASH_LOOP:
+                # started by hand, so it gets another set of tries
+                self.restart_policy.reset()
+            self.status = GameServerStatus.STARTING if self.start_indicator is not None else GameServerStatus.RUNNING
+            if self.detach and not utils.is_windows and ProcessMultiplexer.get().in_thread():
+                # the shim takes a moment to be ready, which would hold up the output and exits of every other server.
+                # this happens when restarting after a crash, or starting because of another server's event
+                Thread(target=self._start_in_background, args=(preexec_fn, previous_status), name=f"Start {self.game}/{self.id}", daemon=True).start()
+                return True
+            self.process = self._create_process(preexec_fn)
+        except Exception:
+            self._on_start_failed(previous_status)
+            raise
+        self._on_process_created()
+        return True
+
+    def _create_process(self, preexec_fn):
+        command = self.placement.wrap_command(self.get_command()) if self.placement is not None else self.get_command()
+        if self.detach and not utils.is_windows:
+            # the shim passes its placement on to the server
+            return ShimProcess.start(command, self.get_directory().path, self.get_shim_directory().path, preexec_fn)
+        return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.get_directory().path, preexec_fn=preexec_fn)
+
+    def _start_in_background(self, preexec_fn, previous_status: GameServerStatus):
+        try:
+            self.process = self._create_process(preexec_fn)
+        except Exception:
+            print(f"Server {self.game}/{self.id} failed to start!")
+            traceback.print_exc()
+            self._on_start_failed(previous_status)
+            return
+        self._on_process_created()
+        if self.status == GameServerStatus.STOPPING:
+            # it was told to stop while the shim was starting, which didn't reach the new process
+            self.process.terminate()
+
+    def _on_process_created(self):
         self.console.clear()
         if self.start_indicator:
-            self.add_event_listener(self._find_start_indicator, GameServerEventType.CONSOLE_LINE)
-        # One thread monitors stdout, and the other monitors stderr
-        Thread(target=self._read_output, args=(True, ), daemon=True).start()
-        Thread(target=self._read_output, args=(False,), daemon=True).start()
-        Thread(target=self._wait_for_stop, daemon=True).start()
+            self._start_trigger = self.add_trigger(self.start_indicator, self._on_start_indicator, once=True)
+        self._watch_process()
+
+    def _on_start_failed(self, previous_status: GameServerStatus):
+        # it never started, so it doesn't need the memory it was admitted with
+        self.status = GameServerStatus.STOPPED if previous_status == GameServerStatus.QUEUED else previous_status
+        if self.admission is not None:
+            self.admission.release(self)
+        # even if the status is the same as before, as whatever is waiting for the start has to know it's done
         self.emit_status_event()
+
+    def reattach(self):
+        """
+        Attaches to the server if it is still running under a shim, like after the manager was restarted.
+        The console is filled from the log first, then the output the shim kept while nobody was attached is added to it.
+
+        :return: True if it was attached, False if it isn't running or is already attached
+        """
+        if utils.is_windows or not self.is_stopped():
+            return False
+        process = ShimProcess.attach(self.get_shim_directory().path)
+        if process is None:
+            return False
+        self.process = process
+        self.console.restore_from_log()
+        # there's no telling if it finished starting while nobody was watching, so assume it did
+        self.status = GameServerStatus.RUNNING
+        self._watch_process()
         return True
 
-    def stop_server(self):
+    def is_detached(self):
+        """
+        Whether the server is running under a shim, so it doesn't have to be stopped when the manager stops.
+        """
+        return isinstance(self.process, ShimProcess) and not self.is_stopped()
+
+    def is_stopped(self):
+        """
+        Whether the server has no process running, which includes being in a crash loop or waiting for memory to start.
+        """
+        return self.status in (GameServerStatus.STOPPED, GameServerStatus.CRASH_LOOP, GameServerStatus.QUEUED)
+
+    def get_memory_reservation(self):
+        """
+        Gets the amount of memory in MiB this server needs to start, 0 if it isn't known.
+        Server types can override this to work it out from their own settings.
+        """
+        return self.memory_reservation or 0
+
+    def _watch_process(self):
+        try:
+            self.ps = psutil.Process(self.process.pid)
+            # the first call to cpu_percent always returns 0, so get that out of the way before the first sample
+            self.ps.cpu_percent()
+        except psutil.NoSuchProcess:
+            # it already exited, which the multiplexer will notice
+            self.ps = None
+        # output and exit of every server is handled by one shared thread
+        ProcessMultiplexer.get().add_process(self.process, self.console.add_line, self._on_exit)
+        self.emit_status_event()
+
+    def stop_server(self, kill_after_timeout = True):
+        """
+        Sends the stop command to the server.
+
+        :param kill_after_timeout: Whether to kill the server if it is still running after `stop_timeout` seconds.
+                                   Turned off by something that escalates on its own, like the manager shutting down
+        """
+        self.cancel_restart()
+        if self.status == GameServerStatus.QUEUED:
+            self.admission.cancel(self)
+            self.status = GameServerStatus.STOPPED
+            self.emit_status_event()
+            return
+        if self.is_stopped():
+            return
         self.status = GameServerStatus.STOPPING
+        if self.process is None:
+            # the first start of a detached server is still creating its shim, which stops it once it exists
+            self.emit_status_event()
+            return
         if self.stop_command == "^C":
             utils.send_ctrl_c(self.process)
         else:
             self.send_console_command(self.stop_command)
-        Thread(target=self._kill_after_timeout, daemon=True).start()
+        self.cancel_kill()
+        if kill_after_timeout:
+            self._kill_timer = ProcessMultiplexer.get().call_later(self.stop_timeout, self._kill_after_timeout, self.process)
         self.emit_status_event()
 
+    def cancel_kill(self):
+        """
+        Cancels killing the server after `stop_timeout` if it is stopping.
+        """
+        timer, self._kill_timer = self._kill_timer, None
+        if timer is not None:
+            timer.cancel()
+
+    def cancel_restart(self):
+        """
+        Cancels the restart after a crash if one is waiting.
+        """
+        timer, self._restart_timer = self._restart_timer, None
+        if timer is not None:
+            timer.cancel()
+
     def send_console_command(self, command):
         """
-        Sends `command` to the stdin of the subprocess, automatically appending a newline
+        Sends `command` to the stdin of the subprocess, automatically appending a newline.
+        The command is queued and written by the multiplexer, so this never blocks, even if the server stopped reading its input.
+
+        :return: A `Future` that is done once the command was written, or fails with an `OSError` if the server isn't running
         """
-        if self.status == GameServerStatus.STOPPED:
-            return
-        self.process.stdin.write(f"{command}\n".encode("utf8"))
-        self.process.stdin.flush()
+        return self.send_console_commands([command])
+
+    def send_console_commands(self, commands: list[str]):
+        """
+        Same as `send_console_command()`, but sends many commands at once, which are written together.
+        """
+        return ProcessMultiplexer.get().write(self.process, "".join(f"{command}\n" for command in commands).encode("utf8"))
 
     # convenience functions to the StorageManager
     def get_directory(self):
@@ -210,6 +393,9 @@ class GameServer:
         """
         return self.storage_manager.get_server_folder(self)
     
+    def get_shim_directory(self):
+        return self.storage_manager.get_shim_folder(self)
+
     def get_file(self, file):
         return self.storage_manager.get_file_from_server(self, file)
 
@@ -260,25 +446,55 @@ class GameServer:
         for name, value, metadata, cls in ValueMetadata.iter_metadatas(self):
             if name not in data:
                 continue
-            if not metadata.flags & MetadataFlags.WRITABLE:
+            value = data[name]
+            if metadata.type == "int" and isinstance(value, str):
+                # number inputs send their value as text, and an empty one means no value
+                try:
+                    value = int(value) if value.strip() else None
+                except ValueError:
+                    failed_keys.append(name)
+                    continue
+            if not metadata.flags & MetadataFlags.WRITABLE or not self.is_valid_setting(name, value):
                 failed_keys.append(name)
                 continue
-            setattr(self, name, data[name])
+            setattr(self, name, value)
         
         return failed_keys
+
+    def is_valid_setting(self, name: str, value):
+        """
+        Checks a value for a setting before `update_from_dict()` sets it.
+        Server types can override this to check their own settings.
+        """
+        parsers = {"cpu_set": parse_cpu_list, "ionice": parse_ionice}
+        if name in parsers and value:
+            try:
+                parsers[name](value)
+            except (ValueError, TypeError, AttributeError):
+                return False
+        # these are passed on to syscalls and sockets, which only take ints in these ranges
+        ranges = {"nice": (-20, 19), "memory_reservation": (0, None), "hibernate_port": (1, 65535), "hibernate_server_port": (1, 65535)}
+        if name in ranges and value is not None:
+            low, high = ranges[name]
+            if not isinstance(value, int) or isinstance(value, bool) or value < low or (high is not None and value > high):
+                return False
+        return True
     
     def get_stats(self) -> Annotated[dict, ValueMetadata(MetadataFlags.NONE)]:
         # TODO should extra stats provided by a server be under a specific key?
-        if self.status == GameServerStatus.STOPPED:
-            return {
-                "cpu": 0,
-                "memory": 0,
-            }
-        with self.ps.oneshot():
-            return {
-                "cpu": self.ps.cpu_percent(),
-                "memory": self.ps.memory_info().rss,
-            }
+        # stats are sampled in the background by the manager, so this never has to wait on the process
+        latest = self.stats_history.latest() if not self.is_stopped() else None
+        if latest is None:
+            return {field: 0 for field in StatsHistory.FIELDS} | self.get_extra_stats()
+        # everything except cpu is a count, so don't send them as floats
+        return {field: value if field == "cpu" else int(value) for field, value in latest.items() if field != "timestamp"} | self.get_extra_stats()
+
+    def get_extra_stats(self):
+        """
+        Gets stats only this type of server has, which are added to the ones from `get_stats()`.
+        Server types should override this instead of `get_stats()`, which is part of the server's metadata.
+        """
+        return {}
     
     def ensure_directory(self):
         try:
@@ -288,72 +504,93 @@ class GameServer:
             # however, the function being called checks instead of catching exception so...
             pass
 
+    def add_trigger(self, pattern: str, handler, regex = False, once = False):
+        """
+        Calls `handler(line, match)` whenever a console line matches `pattern`.
+        This is much cheaper than checking every line in a console line listener, see `ConsoleTriggers`.
+
+        Triggers stay registered across restarts unless `once` is set,
+        so plugins should add them in `init()`.
+
+        :param pattern: The text to look for
+        :param handler: The function to call with the `GameConsoleLine` and the `re.Match` when a line matches
+        :param regex: Whether `pattern` is a regex instead of plain text
+        :param once: Whether to remove the trigger after it matches once
+        :return: The trigger, which can be removed with `remove()`
+        """
+        return self.triggers.add(pattern, handler, regex, once)
+
     def add_event_listener(self, func, filter = None):
-        listener = GameServerEventListener(func, filter)
-        self._listeners.append(listener)
-        return listener
+        return self._listeners.add(func, filter)
 
     def emit_event(self, event: GameServerEvent):
         """
-        Passes the event to `call()` on all listeners,
-        which will then decide if the filter on the listener matches
-        and then call the underlying function.
+        Calls every listener that wants this type of event.
 
         :param event: The event to emit.
         """
-        # remove deregistered listeners from list
-        self._listeners = [listener for listener in self._listeners if listener._registered]
-        for listener in self._listeners:
-            event.listener = listener
-            # the events are filtered in the call method, so this loops over all listeners
-            listener.call(event)
+        event.server = self
+        with self._emit_lock:
+            # settings can change while the server is running, so always use the current limit
+            self.events.max_lines = self.console_max_lines
+            self.events.add(event)
+            self._listeners.dispatch(event)
 
     def emit_status_event(self):
         """Convenience function that emits an event with the current status of the server"""
         self.emit_event(StatusEvent(self.status))
 
-    def _read_output(self, error = False):
-        """
-        Constantly monitors the stdout of the subprocess, and adds it to the server's console object.
-        Will block until the program exits, only call on another thread.
-        """
-        output = self.process.stderr if error else self.process.stdout
-        while self.process.poll() is None:
-            line = output.readline().decode("utf8")
-            if not line: # an empty line means eof, happens when a program writes eof before actually termainating
-                break
-            self.console.add_line(line, error)
-        # TODO could a program terminate before writing eof and cause some output to not get captured?
-        # seems unlikely but if i encounter problems i'll add some code here to capture left over output
-            
-    def _wait_for_stop(self):
+    def _on_exit(self, returncode: int):
         """
-        Blocks until the subprocess exits, then sets the status to stopped.
-        Also will handle crashes if the server is not set to `STOPPING` when it exits.
+        Called by the multiplexer after the subprocess exits, and sets the status to stopped.
+        Also will handle crashes if the server is not set to `STOPPING` when it exits,
+        the `RestartPolicy` decides if and when it is restarted.
         """
-        self.process.wait()
-        crash = self.status != GameServerStatus.STOPPING
-        self.status = GameServerStatus.STOPPED
-        self.emit_status_event()
-        if crash:
-            print(f"Server {self.game}/{self.id} crashed!")
-            if self.restart_on_crash:
-                print("Auto restarting...")
-                self.start_server()
+        self.console.flush_batch()
+        self.console.log.end_session()
+        if self.placer is not None:
+            self.placer.remove_cgroup(self)
+        if self._start_trigger is not None:
+            # the server never finished starting
+            self._start_trigger.remove()
+            self._start_trigger = None
+        if self.status == GameServerStatus.STOPPING:
+            self.status = GameServerStatus.STOPPED
+            self.emit_status_event()
+            return
 
-    def _find_start_indicator(self, event: ConsoleLineEvent):
+        crash = self.restart_policy.on_crash(returncode)
+        self.status = GameServerStatus.CRASH_LOOP if crash.crash_loop else GameServerStatus.STOPPED
+        self.emit_status_event()
+        print(f"Server {self.game}/{self.id} crashed with exit code {returncode}!")
+        if crash.crash_loop:
+            print(f"It crashed more than {self.restart_max} times in {self.restart_window} seconds, not restarting")
+        elif crash.restart_delay is not None:
+            print(f"Auto restarting in {crash.restart_delay:.1f} seconds...")
+            # restarting from a timer means a server that crashes right away doesn't restart from inside its own exit handler
+            self._restart_timer = ProcessMultiplexer.get().call_later(crash.restart_delay, self._restart_after_crash)
+
+    def _restart_after_crash(self):
+        self._restart_timer = None
+        self.start_server()
+
+    def _on_start_indicator(self, line: GameConsoleLine, match):
         """
-        Looks for the start indicator in `line`.
-        Used as console line listener, and doesn't handle special cases like the indicator being `None` or an empty string.
+        Called by the start indicator trigger once it is found in the console.
         """
-        if self.start_indicator not in event.line.line:
+        self._start_trigger = None
+        # it might have been told to stop before it finished starting
+        if self.status != GameServerStatus.STARTING:
             return
         self.status = GameServerStatus.RUNNING
         self.emit_status_event()
-        event.listener.deregister()
 
-    def _kill_after_timeout(self):
-        try:
-            self.process.wait(self.stop_timeout)
-        except subprocess.TimeoutExpired:
-            self.process.kill()
+    def _kill_after_timeout(self, process: subprocess.Popen):
+        self._kill_timer = None
+        # the server might have been restarted since the timer was started, so only kill the process it was started for
+        if process.poll() is None:
+            process.kill()
+
+# circular imports, these need the server classes
+from app.management.admission import Admission, MemoryAdmission
+from app.management.placement import Placement, Placer, parse_cpu_list, parse_ionice
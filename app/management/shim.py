@@ -0,0 +1,359 @@
+"""
+Runs a server under a small process that owns its stdio, so the server keeps running when the manager stops
+and a manager that is started again can attach to it. Used for servers with the `detach` setting on.
+
+The shim is started by `ShimProcess.start()`, which runs `main()` in a new python process with the arguments:
+
+    <directory> <cwd> <command>...
+
+It writes its pid file to `directory` and listens on a Unix socket there. Every connection starts with a single byte
+saying what it is for: the server's stdout or stderr (which start with the kept output that no manager was sent yet,
+so a manager that attaches doesn't lose what was printed while nobody was attached), its stdin, or its exit code. Only one connection of each kind is kept,
+a new one replaces the old one.
+
+Not supported on Windows, as it relies on Unix sockets and sessions.
+"""
+import json
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+SOCKET_NAME = "shim.sock"
+PID_FILE_NAME = "shim.json"
+LOG_FILE_NAME = "shim.log"
+
+ROLE_STDOUT = b"o"
+ROLE_STDERR = b"e"
+ROLE_STDIN = b"i"
+ROLE_EXIT = b"x"
+
+class Shim:
+    """
+    The shim process itself, relays output and input between the server and whichever manager is attached.
+    Output that comes in while no manager is attached is kept up to `BACKLOG_SIZE`, so it isn't lost.
+    Only output a manager wasn't sent before is replayed, so reattaching doesn't log the same lines twice or fire triggers again.
+    Output a manager was sent but didn't read before it stopped is lost.
+    """
+    # bytes of output kept for each stream, for managers that attach later
+    BACKLOG_SIZE = 256 * 1024
+    # amount of bytes to read from a pipe at a time
+    CHUNK_SIZE = 64 * 1024
+    # how often to check if the server has exited
+    EXIT_POLL_INTERVAL = 0.5
+    # how long to keep reading output after the server exits, in case a child of it holds the pipes open
+    PIPE_CLOSE_GRACE = 5
+    # how long to wait for a manager to collect the exit code after the server exits
+    EXIT_LINGER = 300
+    # seconds a manager has to take output before it is dropped, so a stuck manager can't stall the server
+    SEND_TIMEOUT = 10
+
+    def __init__(self, directory: str, cwd: str, command: list[str]):
+        self.directory = directory
+        self.selector = selectors.DefaultSelector()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+        self.backlogs = {ROLE_STDOUT: bytearray(), ROLE_STDERR: bytearray()}
+        # bytes of each stream read from the server so far, and how many of those were sent to a manager
+        self.totals = {ROLE_STDOUT: 0, ROLE_STDERR: 0}
+        self.sent = {ROLE_STDOUT: 0, ROLE_STDERR: 0}
+        self.clients: dict[bytes, socket.socket] = {}
+        self.pipes: dict[int, bytes] = {self.process.stdout.fileno(): ROLE_STDOUT, self.process.stderr.fileno(): ROLE_STDERR}
+        self.stdin_buffer = bytearray()
+        self.stdin_waiting = False
+        self.exited_at: float = None
+        self.returncode: int = None
+        self.delivered = False
+
+        socket_path = os.path.join(directory, SOCKET_NAME)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(socket_path)
+        self.listener.listen()
+        self.listener.setblocking(False)
+
+        # the pid file is written last, so a manager that finds it knows the socket is ready
+        pid_file = os.path.join(directory, PID_FILE_NAME)
+        with open(pid_file + ".tmp", "w") as file:
+            json.dump({"shim_pid": os.getpid(), "pid": self.process.pid}, file)
+        os.replace(pid_file + ".tmp", pid_file)
+
+    def run(self):
+        # stopping the shim means stopping the server, not leaving it running without anyone to talk to it
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.process.terminate())
+        for fd in self.pipes:
+            os.set_blocking(fd, False)
+            self.selector.register(fd, selectors.EVENT_READ, self._on_output)
+        os.set_blocking(self.process.stdin.fileno(), False)
+        self.selector.register(self.listener, selectors.EVENT_READ, self._on_connect)
+
+        while True:
+            for key, mask in self.selector.select(self.EXIT_POLL_INTERVAL):
+                key.data(key.fileobj)
+            if self.returncode is not None:
+                if self.delivered or time.monotonic() - self.exited_at > self.EXIT_LINGER:
+                    break
+            elif self.process.poll() is not None:
+                if self.exited_at is None:
+                    self.exited_at = time.monotonic()
+                if not self.pipes or time.monotonic() - self.exited_at > self.PIPE_CLOSE_GRACE:
+                    self._finish()
+        self._cleanup()
+
+    def _on_output(self, fd: int):
+        role = self.pipes[fd]
+        try:
+            data = os.read(fd, self.CHUNK_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.selector.unregister(fd)
+            os.close(fd)
+            del self.pipes[fd]
+            return
+        self.totals[role] += len(data)
+        backlog = self.backlogs[role]
+        backlog += data
+        if len(backlog) > self.BACKLOG_SIZE:
+            # only keep whole lines
+            newline = backlog.find(b"\n", len(backlog) - self.BACKLOG_SIZE)
+            del backlog[:newline + 1 if newline != -1 else len(backlog) - self.BACKLOG_SIZE]
+        client = self.clients.get(role)
+        if client is not None and self._send(role, client, data):
+            self.sent[role] = self.totals[role]
+
+    def _on_connect(self, listener: socket.socket):
+        try:
+            conn, _ = listener.accept()
+        except BlockingIOError:
+            return
+        conn.settimeout(self.SEND_TIMEOUT)
+        self.selector.register(conn, selectors.EVENT_READ, self._on_hello)
+
+    def _on_hello(self, conn: socket.socket):
+        self.selector.unregister(conn)
+        try:
+            role = conn.recv(1)
+        except OSError:
+            role = b""
+        if role in self.backlogs:
+            backlog = self.backlogs[role]
+            # anything older than the backlog is gone, whether it was sent or not
+            unsent = min(self.totals[role] - self.sent[role], len(backlog))
+            if not self._send(role, conn, bytes(backlog[len(backlog) - unsent:])):
+                conn.close()
+                return
+            self.sent[role] = self.totals[role]
+            if self.returncode is not None:
+                # the server already exited, so the backlog is all there is
+                conn.close()
+                return
+        elif role == ROLE_EXIT and self.returncode is not None:
+            self._send_exit(conn)
+            return
+        elif role not in (ROLE_STDIN, ROLE_EXIT) or self.returncode is not None:
+            conn.close()
+            return
+        self._drop(role)
+        self.clients[role] = conn
+        # output and exit connections never send anything, so this only fires when they close
+        self.selector.register(conn, selectors.EVENT_READ, lambda conn, role=role: self._on_client_readable(role, conn))
+
+    def _on_client_readable(self, role: bytes, conn: socket.socket):
+        try:
+            data = conn.recv(self.CHUNK_SIZE)
+        except OSError:
+            data = b""
+        if not data:
+            self._drop(role)
+        elif role == ROLE_STDIN:
+            self.stdin_buffer += data
+            self._flush_input()
+
+    def _flush_input(self, *args):
+        stdin = self.process.stdin
+        while self.stdin_buffer:
+            try:
+                written = os.write(stdin.fileno(), self.stdin_buffer)
+            except BlockingIOError:
+                break
+            except OSError:
+                # the server closed its input, nothing more can be written
+                self.stdin_buffer.clear()
+                break
+            del self.stdin_buffer[:written]
+        if self.stdin_buffer and not self.stdin_waiting:
+            self.selector.register(stdin, selectors.EVENT_WRITE, self._flush_input)
+            self.stdin_waiting = True
+        elif not self.stdin_buffer and self.stdin_waiting:
+            self.selector.unregister(stdin)
+            self.stdin_waiting = False
+
+    def _send(self, role: bytes, conn: socket.socket, data: bytes):
+        try:
+            conn.sendall(data)
+        except OSError:
+            if self.clients.get(role) is conn:
+                self._drop(role)
+            else:
+                conn.close()
+            return False
+        return True
+
+    def _send_exit(self, conn: socket.socket):
+        try:
+            conn.sendall(f"{self.returncode}\n".encode())
+        except OSError:
+            pass
+        else:
+            self.delivered = True
+        conn.close()
+
+    def _drop(self, role: bytes):
+        conn = self.clients.pop(role, None)
+        if conn is not None:
+            self.selector.unregister(conn)
+            conn.close()
+
+    def _finish(self):
+        """Called once the server has exited and its output was read"""
+        for fd in list(self.pipes):
+            self.selector.unregister(fd)
+            os.close(fd)
+        self.pipes.clear()
+        self.returncode = self.process.returncode
+        # closing the output first means the manager has all of it by the time it gets the exit code
+        for role in (ROLE_STDOUT, ROLE_STDERR, ROLE_STDIN):
+            self._drop(role)
+        conn = self.clients.pop(ROLE_EXIT, None)
+        if conn is not None:
+            self.selector.unregister(conn)
+            self._send_exit(conn)
+
+    def _cleanup(self):
+        for name in (SOCKET_NAME, PID_FILE_NAME):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+class ShimProcess:
+    """
+    Stands in for the `subprocess.Popen` of a server that runs under a shim, so the rest of the manager doesn't need to care.
+
+    Output and input go through connections to the shim, while signals are sent straight to the server process,
+    which isn't a child of the manager, so its exit code comes from the shim too.
+    """
+    # seconds to wait for a new shim to be ready
+    START_TIMEOUT = 10
+
+    def __init__(self, directory: str, pid: int):
+        self.directory = directory
+        self.pid = pid
+        self.returncode: int = None
+        self._lock = threading.Lock()
+        self._exit = self._connect(ROLE_EXIT)
+        self._exit.setblocking(False)
+        self.stdout = os.fdopen(self._connect(ROLE_STDOUT).detach(), "rb")
+        self.stderr = os.fdopen(self._connect(ROLE_STDERR).detach(), "rb")
+        self.stdin = os.fdopen(self._connect(ROLE_STDIN).detach(), "wb")
+
+    @classmethod
+    def start(cls, command: list[str], cwd: str, directory: str, preexec_fn = None):
+        """
+        Starts `command` under a new shim, in its own session so it isn't stopped along with the manager.
+
+        :param directory: Where the shim keeps its socket and pid file
+        :param preexec_fn: Run in the shim process before it starts, see `subprocess.Popen`
+        :raises OSError: If the shim didn't start
+        """
+        directory = os.path.abspath(directory)
+        os.makedirs(directory, exist_ok=True)
+        pid_file = os.path.join(directory, PID_FILE_NAME)
+        if os.path.exists(pid_file):
+            os.remove(pid_file)
+        # the shim imports this module, so it has to run from the folder the app package is in
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        with open(os.path.join(directory, LOG_FILE_NAME), "ab") as log:
+            # not run with -m, as the package imports this module before it would run, which makes python warn
+            shim = subprocess.Popen([sys.executable, "-c", "from app.management.shim import main; main()", directory, os.path.abspath(cwd), *command],
+                                    stdin=subprocess.DEVNULL, stdout=log, stderr=log, cwd=root, start_new_session=True, preexec_fn=preexec_fn)
+        deadline = time.monotonic() + cls.START_TIMEOUT
+        while (process := cls.attach(directory)) is None:
+            if shim.poll() is not None:
+                raise OSError(f"The shim exited with code {shim.returncode}, see {os.path.join(directory, LOG_FILE_NAME)}")
+            if time.monotonic() > deadline:
+                shim.kill()
+                raise OSError("Timed out waiting for the shim to start")
+            time.sleep(0.05)
+        return process
+
+    @classmethod
+    def attach(cls, directory: str):
+        """
+        Attaches to the shim in `directory`, if one is running there.
+
+        :return: The `ShimProcess`, or None if there isn't a shim running there
+        """
+        directory = os.path.abspath(directory)
+        try:
+            with open(os.path.join(directory, PID_FILE_NAME)) as file:
+                pid = json.load(file)["pid"]
+            return cls(directory, pid)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _connect(self, role: bytes):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(os.path.join(self.directory, SOCKET_NAME))
+            conn.sendall(role)
+        except OSError:
+            conn.close()
+            raise
+        return conn
+
+    def exit_fileno(self):
+        """
+        A file descriptor that becomes readable once the server has exited, see `ProcessMultiplexer`.
+        """
+        return self._exit.fileno()
+
+    def poll(self):
+        with self._lock:
+            if self.returncode is None:
+                try:
+                    data = self._exit.recv(64)
+                except BlockingIOError:
+                    return None
+                except OSError:
+                    data = b""
+                # the shim always sends the exit code before closing, so nothing means the shim itself died
+                self.returncode = int(data) if data.strip() else -1
+            return self.returncode
+
+    def send_signal(self, sig: int):
+        if self.poll() is not None:
+            return
+        try:
+            os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+def main():
+    if len(sys.argv) < 4:
+        print("Usage: <directory> <cwd> <command>...", file=sys.stderr)
+        sys.exit(2)
+    Shim(sys.argv[1], sys.argv[2], sys.argv[3:]).run()
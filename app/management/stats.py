@@ -0,0 +1,166 @@
+from array import array
+from collections import defaultdict
+import time
+from threading import Event, Lock, Thread
+import traceback
+
+import psutil
+
+from app.management.events import StatsEvent
+
+class StatsHistory:
+    """
+    Fixed size time series of resource stats for one server.
+
+    Each stat is stored in its own preallocated array of doubles used as a ring buffer,
+    so the memory used never changes and the latest sample can be read in constant time.
+    """
+    FIELDS = ("cpu", "memory", "uss", "pss", "threads", "processes", "read_bytes", "write_bytes")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.timestamps = array('d', bytes(8 * size))
+        self.values = {field: array('d', bytes(8 * size)) for field in self.FIELDS}
+        self._next = 0
+        self._count = 0
+        self._lock = Lock()
+
+    def add(self, timestamp: float, sample: dict[str, float]):
+        with self._lock:
+            self.timestamps[self._next] = timestamp
+            for field, values in self.values.items():
+                values[self._next] = sample.get(field, 0)
+            self._next = (self._next + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+
+    def latest(self):
+        """
+        Gets the newest sample.
+
+        :return: A dict with the timestamp and every stat, or None if there aren't any samples
+        """
+        with self._lock:
+            if not self._count:
+                return None
+            index = self._next - 1
+            return {"timestamp": self.timestamps[index]} | {field: values[index] for field, values in self.values.items()}
+
+    def get_history(self, window: float = None, points: int = None):
+        """
+        Gets the samples from the last `window` seconds, averaged down to at most `points` samples.
+
+        :param window: How far back to go in seconds, defaults to None meaning all samples
+        :param points: The maximum amount of samples to return, defaults to None meaning don't downsample
+        :return: A dict of lists, with one list of timestamps and one list for each stat
+        """
+        with self._lock:
+            indexes = [(self._next - self._count + i) % self.size for i in range(self._count)]
+            if window is not None and indexes:
+                start = self.timestamps[indexes[-1]] - window
+                indexes = [i for i in indexes if self.timestamps[i] >= start]
+            columns = {"timestamp": self.timestamps} | self.values
+            if points is None or len(indexes) <= points:
+                return {name: [column[i] for i in indexes] for name, column in columns.items()}
+            # split the samples into evenly sized buckets and average them
+            buckets = [indexes[len(indexes) * n // points:len(indexes) * (n + 1) // points] for n in range(points)]
+            return {name: [sum(column[i] for i in bucket) / len(bucket) for bucket in buckets] for name, column in columns.items()}
+
+class StatsSampler:
+    """
+    Samples the resource usage of every running server on a single background thread,
+    so that getting stats never has to wait on psutil.
+    """
+    def __init__(self, manager: 'ServerManager', interval: float):
+        self.manager = manager
+        self.interval = interval
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="StatsSampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def sample(self):
+        """
+        Samples every running server once.
+
+        Servers are measured across their whole process tree, so a launcher script doesn't hide the real game process.
+        Finding the trees only takes one scan of all processes, no matter how many servers there are.
+        """
+        now = time.time()
+        servers = [server for server in list(self.manager.servers.values()) if server.ps is not None and server.process.poll() is None]
+        if not servers:
+            return
+
+        # process_iter reuses the same Process objects between calls, which cpu_percent needs to work
+        processes: dict[int, psutil.Process] = {}
+        children: dict[int, list[int]] = defaultdict(list)
+        for process in psutil.process_iter(["ppid"]):
+            processes[process.pid] = process
+            children[process.info["ppid"]].append(process.pid)
+
+        for server in servers:
+            if server.ps.pid not in processes:
+                # it exited after getting the list of servers
+                continue
+            # use the server's own Process object for the root, as it has already been primed for cpu_percent
+            tree = [server.ps]
+            pids = list(children[server.ps.pid])
+            while pids:
+                pid = pids.pop()
+                tree.append(processes[pid])
+                pids += children[pid]
+            server.stats_history.add(now, self.sample_tree(tree))
+            server.emit_event(StatsEvent(server.get_stats()))
+
+    @staticmethod
+    def sample_tree(tree: list[psutil.Process]):
+        """
+        Adds up the stats of every process in `tree`.
+        Processes that exit while being sampled are skipped.
+        """
+        sample = dict.fromkeys(StatsHistory.FIELDS, 0)
+        for process in tree:
+            try:
+                process_sample = StatsSampler.sample_process(process)
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                continue
+            for field, value in process_sample.items():
+                sample[field] += value
+            sample["processes"] += 1
+        return sample
+
+    @staticmethod
+    def sample_process(ps: psutil.Process):
+        with ps.oneshot():
+            sample = {
+                "cpu": ps.cpu_percent(),
+                "threads": ps.num_threads(),
+            }
+            # uss and pss don't count shared libraries multiple times across the tree,
+            # but getting them might need more permissions and pss is only on Linux
+            try:
+                memory = ps.memory_full_info()
+            except psutil.AccessDenied:
+                memory = ps.memory_info()
+            sample["memory"] = memory.rss
+            sample["uss"] = getattr(memory, "uss", 0)
+            sample["pss"] = getattr(memory, "pss", 0)
+            # io counters aren't available on every platform, or might need more permissions
+            try:
+                io = ps.io_counters()
+            except (AttributeError, psutil.AccessDenied):
+                pass
+            else:
+                sample["read_bytes"] = io.read_bytes
+                sample["write_bytes"] = io.write_bytes
+        return sample
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                traceback.print_exc()
@@ -110,6 +110,8 @@ class StorageManager:
         self.base_dir = Directory(base_dir)
         self.servers_dir = self.base_dir.get_directory("servers")
         self.storage_dir = self.base_dir.get_directory("storage")
+        # servers that keep running when the manager stops have their shim files here, see `app.management.shim`
+        self.shims_dir = self.base_dir.get_directory("shims")
 
     def get_bin(self, game, bin):
         return self.storage_dir.get_directory(game).get_directory(bin)
@@ -121,6 +123,9 @@ class StorageManager:
         # FUTURE use UUIDs for server directories instead of type and name
         return self.servers_dir.get_directory(server.game).get_directory(server.id)
     
+    def get_shim_folder(self, server: 'GameServer'):
+        return self.shims_dir.get_directory(server.game).get_directory(server.id)
+
     def get_base_directory(self, dir: Directory, path: str):
         paths = path.split('/')
         while paths:
@@ -0,0 +1,106 @@
+import re
+from threading import Lock
+import traceback
+
+class ConsoleTrigger:
+    """
+    A pattern to look for in console lines, and the function to call when a line matches it.
+    Created with `GameServer.add_trigger()`.
+    """
+    def __init__(self, triggers: 'ConsoleTriggers', pattern: str, handler, regex = False, once = False):
+        self.triggers = triggers
+        self.pattern = pattern
+        self.handler = handler
+        self.regex = regex
+        self.once = once
+        self.compiled = re.compile(pattern if regex else re.escape(pattern))
+
+    def remove(self):
+        self.triggers.remove(self)
+
+class ConsoleTriggers:
+    """
+    Every trigger of one server, checked against each console line.
+
+    All the patterns that can be are combined into one regex, so a line that doesn't match any of them,
+    which is almost every line, is only scanned once no matter how many triggers there are.
+    Only when the combined regex finds something are the triggers checked one by one.
+
+    Patterns with backreferences or named groups would mean something else in the combined regex,
+    so those are always checked on their own.
+    """
+    def __init__(self):
+        self._triggers: dict[ConsoleTrigger, None] = {}
+        self._lock = Lock()
+        # rebuilt whenever a trigger is added or removed, and replaced in one go so scanning never needs the lock
+        self._compiled: tuple[re.Pattern | None, tuple[ConsoleTrigger, ...], tuple[ConsoleTrigger, ...]] = (None, (), ())
+
+    def add(self, pattern: str, handler, regex = False, once = False):
+        """
+        Calls `handler(line, match)` for every console line that matches `pattern`,
+        where `line` is the `GameConsoleLine` and `match` is the `re.Match` of the pattern.
+
+        :param pattern: The text to look for
+        :param handler: The function to call when a line matches
+        :param regex: Whether `pattern` is a regex instead of plain text
+        :param once: Whether to remove the trigger after it matches once
+        :raises re.error: If `regex` is set and `pattern` isn't a valid regex
+        :return: The trigger, which can be removed with `remove()`
+        """
+        trigger = ConsoleTrigger(self, pattern, handler, regex, once)
+        with self._lock:
+            self._triggers[trigger] = None
+            self._rebuild()
+        return trigger
+
+    def remove(self, trigger: ConsoleTrigger):
+        with self._lock:
+            if self._triggers.pop(trigger, False) is not False:
+                self._rebuild()
+
+    def scan(self, line: 'GameConsoleLine'):
+        """
+        Checks `line` against every trigger, and calls the handlers of the ones that match.
+        """
+        combined, combined_triggers, separate_triggers = self._compiled
+        if combined is not None and combined.search(line.line) is not None:
+            self._check(combined_triggers, line)
+        if separate_triggers:
+            self._check(separate_triggers, line)
+
+    def _check(self, triggers: tuple[ConsoleTrigger, ...], line: 'GameConsoleLine'):
+        for trigger in triggers:
+            match = trigger.compiled.search(line.line)
+            if match is None:
+                continue
+            if trigger.once:
+                trigger.remove()
+            try:
+                trigger.handler(line, match)
+            except Exception:
+                # a broken plugin shouldn't stop the rest of the triggers or the console
+                traceback.print_exc()
+
+    def _rebuild(self):
+        combined_triggers = []
+        separate_triggers = []
+        for trigger in self._triggers:
+            if self._can_combine(trigger):
+                combined_triggers.append(trigger)
+            else:
+                separate_triggers.append(trigger)
+        combined = re.compile("|".join(f"(?:{trigger.compiled.pattern})" for trigger in combined_triggers)) if combined_triggers else None
+        self._compiled = (combined, tuple(combined_triggers), tuple(separate_triggers))
+
+    @staticmethod
+    def _can_combine(trigger: ConsoleTrigger):
+        if not trigger.regex:
+            return True
+        if trigger.compiled.groupindex or re.search(r"\\[1-9]|\(\?P=", trigger.pattern):
+            return False
+        try:
+            # global flags like (?i) are only allowed at the very start of a regex
+            re.compile(f"(?:{trigger.pattern})")
+        except re.error:
+            return False
+        return True
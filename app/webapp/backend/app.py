@@ -1,3 +1,4 @@
+import asyncio
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 
@@ -25,14 +26,26 @@ async def lifespan(app: FastAPI):
     manager: ServerManager = app.state.server_manager
     manager.load_settings()
     manager.load_servers()
+    manager.start_stats_sampler()
+    manager.start_hibernator()
     manager.auto_start_servers()
     yield
-    manager.wait_for_shutdown()
+    manager.stop_stats_sampler()
+    # connections shouldn't wake servers up while they are being stopped
+    manager.stop_hibernator()
+    # stopping can take a while, so don't block the event loop while waiting
+    results = await asyncio.to_thread(manager.wait_for_shutdown)
+    for name, result in results.items():
+        if result["seconds"] is None:
+            print(f"Server {name} didn't stop!")
+        else:
+            print(f"Server {name} stopped in {result['seconds']:.1f}s ({result['escalation']}, exit code {result['returncode']})")
     manager.save_settings()
     manager.save_servers()
 
 app = FastAPI(root_path="/api", lifespan=lifespan)
 
 app.include_router(servers.router)
+app.include_router(servers.websocket_router)
 app.include_router(auth.router)
 app.include_router(setup.router)
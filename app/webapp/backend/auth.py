@@ -7,7 +7,7 @@ import jwt
 from typing import Annotated
 from pydantic import BaseModel
 
-from .routers.servers import ManagerDependency
+from .dependencies import ManagerDependency
 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRES_MINUTES = 15
@@ -37,10 +37,19 @@ def create_user_access_token(user, secret_key):
     access_token = create_token({"sub": user}, secret_key, timedelta(minutes=ACCESS_TOKEN_EXPIRES_MINUTES))
     return Token(access_token=access_token, token_type="bearer")
 
+def decode_token(token: str, secret_key):
+    """
+    Checks that a token was made by us and hasn't expired.
+
+    :raises jwt.InvalidTokenError: If the token isn't valid
+    :return: The data stored in the token
+    """
+    return jwt.decode(token, secret_key, [ALGORITHM])
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], token_secret: TokenSecret):
     credentials_exception = HTTPException(401, "Invalid Credentials", {"WWW-Authenticate": "Bearer"})
     try:
-        payload = jwt.decode(token, token_secret, [ALGORITHM])
+        payload = decode_token(token, token_secret)
     except jwt.InvalidTokenError:
         raise credentials_exception
     return payload
@@ -11,6 +11,19 @@ class Metadata(BaseModel, Generic[T]):
 class ServerStats(BaseModel):
     cpu: float
     memory: int
+    uss: int = 0
+    pss: int = 0
+    threads: int = 0
+    processes: int = 0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    # only for servers that can count their players
+    players: int | None = None
+
+class ConsoleCommands(BaseModel):
+    # either one command, or a list of commands that are written all at once
+    command: str | None = None
+    commands: list[str] = []
 
 class Server(BaseModel):
     game: Metadata[str]
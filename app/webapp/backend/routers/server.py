@@ -1,17 +1,32 @@
 import asyncio
+from concurrent.futures import Future
+import datetime
 import json
+import re
 from typing import Annotated
-from fastapi import APIRouter, Depends, Request, Response, HTTPException
+from fastapi import APIRouter, Depends, Header, Query, Request, Response, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+import jwt
 import urllib.parse
 from sse_starlette import EventSourceResponse
 
+from app.management.console_search import ConsoleQuery
+from app.management.events import GameServerEvent, GameServerEventType
 from app.management.manager import ServerManager
-from app.management.server import GameServer, GameServerEvent
+from app.management.server import GameServer
 from app.management.storage import File, FileType
+from ..auth import decode_token
+from ..models import ConsoleCommands
+from ..streaming import EventSubscriber
 
 router = APIRouter(
     prefix="/{type}/{id}",
 )
+# browsers can't set headers on websockets, so websocket routes check the token themselves
+# and are kept on their own router that doesn't require the Authorization header
+websocket_router = APIRouter(
+    prefix="/{type}/{id}",
+)
 
 def server_dependency(type: str, id: str, request: Request):
     manager: ServerManager = request.app.state.server_manager
@@ -35,8 +50,9 @@ def get_server(server: ServerDependency):
     return server.as_dict(True)
 
 @router.put("")
-def update_server(server: ServerDependency, body: dict):
-    failed_keys = server.update_from_dict(body)
+def update_server(server: ServerDependency, body: dict, request: Request):
+    manager: ServerManager = request.app.state.server_manager
+    failed_keys = manager.update_server(server, body)
     # TODO change response based if there were any failures or not,
     # i want to add better error reporting on this first tho
     return {
@@ -55,51 +71,246 @@ def stop_server(server: ServerDependency):
     server.stop_server()
     return temp
 
+@router.get("/stats/history")
+def get_stats_history(server: ServerDependency, request: Request, window: float | None = None, points: int | None = 120):
+    """
+    Gets the stats sampled over the last `window` seconds, averaged down to `points` samples.
+    """
+    manager: ServerManager = request.app.state.server_manager
+    return {
+        "interval": manager.config.stats_interval,
+        **server.stats_history.get_history(window, points),
+    }
+
+@router.get("/placement")
+def get_placement(server: ServerDependency):
+    """
+    Gets where the server was placed when it last started, or null if nothing was applied.
+    """
+    return server.placement.as_dict() if server.placement is not None else None
+
+@router.get("/crashes")
+def get_crashes(server: ServerDependency):
+    """
+    Gets the recent crashes of the server, newest first, with the last console lines before each one.
+    """
+    return {"crashes": [crash.as_dict() for crash in reversed(server.restart_policy.crashes)]}
+
+# TODO move these to some sort of config file
+CONSOLE_PAGE_SIZE = 200
+CONSOLE_PAGE_MAX_SIZE = 1000
+CONSOLE_SEARCH_LIMIT = 1000 # max amount of matches returned by one search
+COMMAND_WRITE_TIMEOUT = 5 # seconds to wait for commands to be written before responding
+
 @router.get("/console")
-def get_server_console(server: ServerDependency):
-    # TODO send only part of the console and have more load as the user scrolls up
-    return server.console.as_dict()
+def get_server_console(server: ServerDependency, before: int | None = None, after: int | None = None, limit: int = CONSOLE_PAGE_SIZE):
+    """
+    Gets the newest lines of the console.
+    Older lines can be loaded with `before` set to the oldest sequence number the client has,
+    and lines that were missed can be loaded with `after` set to the newest one.
+    """
+    return Response(server.console.get_page(before, after, min(limit, CONSOLE_PAGE_MAX_SIZE)), media_type="application/json")
 
 @router.post("/console")
-def run_command(server: ServerDependency, command: dict):
-    server.send_console_command(command['command'])
+async def run_command(server: ServerDependency, body: ConsoleCommands):
+    """
+    Sends commands to the console of the server, and returns once they were written.
+    """
+    commands = ([body.command] if body.command is not None else []) + body.commands
+    if not commands:
+        raise HTTPException(400, "No commands given")
+    try:
+        await asyncio.wait_for(asyncio.wrap_future(server.send_console_commands(commands)), COMMAND_WRITE_TIMEOUT)
+    except asyncio.TimeoutError:
+        # it is still queued, the server just isn't reading its input right now
+        # this has to be caught first, as TimeoutError is also an OSError
+        raise HTTPException(504, "Server isn't reading commands")
+    except OSError:
+        raise HTTPException(409, "Server isn't running")
     return temp
 
+@router.get("/logs")
+def get_console_logs(server: ServerDependency):
+    """
+    Lists the saved console log sessions, oldest first.
+    """
+    return server.console.log.list_sessions()
+
+@router.get("/logs/{session}")
+def get_console_log(server: ServerDependency, session: str):
+    """
+    Streams every line of a saved console log session, as newline delimited JSON.
+    """
+    if not server.console.log.session_exists(session):
+        raise HTTPException(404)
+    return StreamingResponse(server.console.log.iter_session(session), media_type="application/x-ndjson")
+
+@router.get("/console/search")
+def search_server_console(server: ServerDependency, q: str, regex: bool = False, case_sensitive: bool = False,
+                          start: datetime.datetime | None = None, end: datetime.datetime | None = None, limit: int = CONSOLE_SEARCH_LIMIT):
+    """
+    Searches the console lines in memory and every saved console log session, newest first.
+    Matches are streamed as newline delimited JSON, with the session each line is from.
+    """
+    try:
+        query = ConsoleQuery(q, regex, case_sensitive, start, end)
+    except re.error as e:
+        raise HTTPException(400, f"Invalid regex: {e}")
+    matches = server.console.search(query, min(limit, CONSOLE_SEARCH_LIMIT))
+    return StreamingResponse((json.dumps(match) + "\n" for match in matches), media_type="application/x-ndjson")
+
 # TODO move these to some sort of config file
-MESSAGE_STREAM_DELAY = 1 # in seconds
 MESSAGE_STREAM_RETRY_TIMEOUT = 15000 # in milliseconds
+MESSAGE_STREAM_QUEUE_SIZE = 1000 # max amount of events waiting to be sent to one client
 
 @router.get('/stream')
-async def event_stream(server: ServerDependency, request: Request):
+async def event_stream(server: ServerDependency, last_event_id: Annotated[str | None, Header()] = None,
+                       last_event_id_query: Annotated[str | None, Query(alias="lastEventId")] = None):
+    """
+    Streams the events of a server.
+
+    Every event has an id, and a client that reconnects with the id of the last event it got,
+    either in the `Last-Event-ID` header or the `lastEventId` query parameter, first gets only the events it missed.
+    If those aren't kept anymore a `resync` event is sent instead, and the client should refetch everything.
+    """
+    def format_event(event: GameServerEvent):
+        return {
+            "id": server.events.get_id(event),
+            "retry": MESSAGE_STREAM_RETRY_TIMEOUT,
+            "event": event.type.name.lower(),
+            # use data_json to only get data, as the event type is already encoded in the event
+            # also manually convert to JSON, as that isn't done automatically here for some reason
+            "data": event.data_json(),
+        }
+
     async def event_generator():
-        events: list[GameServerEvent] = []
-        def add_to_event_queue(event: GameServerEvent):
-            events.append(event)
-        listener = server.add_event_listener(add_to_event_queue)
-
-        while True:
-            if await request.is_disconnected():
-                listener.deregister()
-                break
-
-            while events:
-                event = events.pop(0)
-                yield {
-                    # TODO does this event need to have an id field?
-                    "retry": MESSAGE_STREAM_RETRY_TIMEOUT,
-                    "event": event.type.name.lower(),
-                    # use data_dict to only get data, as the event type is already encoded in the event
-                    # also manually convert to JSON, as that isn't done automatically here for some reason
-                    "data": json.dumps(event.data_dict())
-                }
-
-            await asyncio.sleep(MESSAGE_STREAM_DELAY)
+        # the subscriber is closed when the client disconnects, because the generator gets cancelled
+        with EventSubscriber(MESSAGE_STREAM_QUEUE_SIZE) as subscriber:
+            # clients get console lines in batches, so skip the events for single lines
+            for type in GameServerEventType:
+                if type != GameServerEventType.CONSOLE_LINE:
+                    subscriber.subscribe(server, type)
+
+            # this is done after subscribing so nothing gets missed in between,
+            # any events that were replayed and also queued are skipped below
+            replayed_seq = -1
+            resume_id = last_event_id or last_event_id_query
+            if resume_id is not None:
+                missed = server.events.get_since(resume_id)
+                if missed is None:
+                    yield {
+                        "retry": MESSAGE_STREAM_RETRY_TIMEOUT,
+                        "event": "resync",
+                        "data": json.dumps({}),
+                    }
+                else:
+                    for event in missed:
+                        yield format_event(event)
+                    if missed:
+                        replayed_seq = missed[-1].seq
+
+            while True:
+                event = await subscriber.get()
+                if event.seq <= replayed_seq:
+                    continue
+
+                dropped = subscriber.take_dropped()
+                if dropped:
+                    # the client is missing events, so tell it to refetch everything
+                    yield {
+                        "retry": MESSAGE_STREAM_RETRY_TIMEOUT,
+                        "event": "overflow",
+                        "data": json.dumps({"dropped": dropped}),
+                    }
+
+                yield format_event(event)
     # The default for Cache-Control header just has no-cache,
     # but we need no-transform to get the React dev server to not apply compression,
     # because it is hardcoded to be on for some reason,
     # and the EventSource API just doesn't work if the request has compression.
     return EventSourceResponse(event_generator(), headers={"Cache-Control": "no-cache, no-transform"})
 
+WEBSOCKET_AUTH_TIMEOUT = 10 # seconds a websocket has to send its token, if it isn't in the url
+
+def _websocket_event(event: str, data: str):
+    """Formats an event sent over a websocket, `data` is already JSON"""
+    return f'{{"event":"{event}","data":{data}}}'
+
+@websocket_router.websocket("/ws")
+async def console_websocket(websocket: WebSocket, type: str, id: str, token: str | None = None):
+    """
+    Streams the events of a server like `/stream`, and takes console commands on the same connection,
+    so a command doesn't need its own request.
+
+    The token can be given with the `token` query parameter, or in the first message as `{"token": "..."}`.
+    Every message is JSON. Events are sent as `{"event": <type>, "data": <data>}`,
+    and commands are sent as `{"command": "..."}` or `{"commands": [...]}` to write many at once,
+    with an optional `id` that is sent back in a `command` event once they were written, or in an `error` event if they couldn't be.
+    """
+    await websocket.accept()
+    if token is None:
+        try:
+            token = json.loads(await asyncio.wait_for(websocket.receive_text(), WEBSOCKET_AUTH_TIMEOUT))["token"]
+        except (asyncio.TimeoutError, ValueError, KeyError, TypeError):
+            pass
+        except WebSocketDisconnect:
+            return
+    try:
+        decode_token(token or "", websocket.app.state.server_manager.env_config.TOKEN_SECRET)
+    except jwt.InvalidTokenError:
+        await websocket.close(1008, "Invalid Credentials")
+        return
+    try:
+        server = server_dependency(type, id, websocket)
+    except HTTPException:
+        # close codes from 4000 are for applications to use, so use one that looks like the http status
+        await websocket.close(4404, "Server not Found")
+        return
+
+    with EventSubscriber(MESSAGE_STREAM_QUEUE_SIZE) as subscriber:
+        # clients get console lines in batches, so skip the events for single lines
+        for event_type in GameServerEventType:
+            if event_type != GameServerEventType.CONSOLE_LINE:
+                subscriber.subscribe(server, event_type)
+        sender = asyncio.create_task(_send_websocket_events(websocket, subscriber))
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    message = json.loads(await websocket.receive_text())
+                    commands = message["commands"] if "commands" in message else [message["command"]]
+                    if not commands or not all(isinstance(command, str) for command in commands):
+                        raise TypeError()
+                except (ValueError, KeyError, TypeError):
+                    await websocket.send_text(_websocket_event("error", json.dumps({"error": 'Expected {"command": "..."}'})))
+                    continue
+                future = server.send_console_commands(commands)
+                if "id" in message:
+                    # acknowledge it once it is written, without holding up the next message
+                    future.add_done_callback(lambda future, id=message["id"]: asyncio.run_coroutine_threadsafe(_acknowledge_command(websocket, id, future), loop))
+        except WebSocketDisconnect:
+            pass
+        finally:
+            sender.cancel()
+
+async def _acknowledge_command(websocket: WebSocket, id, future: Future):
+    try:
+        future.result()
+    except OSError:
+        await websocket.send_text(_websocket_event("error", json.dumps({"id": id, "error": "Server isn't running"})))
+    else:
+        await websocket.send_text(_websocket_event("command", json.dumps({"id": id})))
+
+async def _send_websocket_events(websocket: WebSocket, subscriber: EventSubscriber):
+    while True:
+        events = await subscriber.get_batch()
+        dropped = subscriber.take_dropped()
+        if dropped:
+            # the client is missing events, so tell it to refetch everything
+            await websocket.send_text(_websocket_event("overflow", json.dumps({"dropped": dropped})))
+        for event in events:
+            await websocket.send_text(_websocket_event(event.type.name.lower(), event.data_json()))
+
 # A trailing slash is required with the variable in the route below,
 # this is here so that it can be omitted
 @router.get('/files')
@@ -1,8 +1,13 @@
+import json
 from fastapi import APIRouter, Depends
+from sse_starlette import EventSourceResponse
+
+from app.management.events import GameServerEventType
 
 from ..dependencies import ManagerDependency
 from ..models import Server
-from .server import router as serverRouter
+from .server import router as serverRouter, websocket_router as serverWebsocketRouter, MESSAGE_STREAM_QUEUE_SIZE, MESSAGE_STREAM_RETRY_TIMEOUT
+from ..streaming import EventSubscriber
 from ..auth import get_current_user
 
 router = APIRouter(
@@ -12,9 +17,68 @@ router = APIRouter(
 )
 router.include_router(serverRouter)
 
+# websockets check their own token, see the server router
+websocket_router = APIRouter(
+    prefix="/servers",
+    tags=["servers"],
+)
+websocket_router.include_router(serverWebsocketRouter)
+
 @router.get("")
 def get_servers(manager: ManagerDependency) -> list[Server]:
-    return [server.as_dict(True) for server in manager.servers]
+    return [server.as_dict(True) for server in manager.servers.values()]
+
+@router.get("/stream")
+async def dashboard_stream(manager: ManagerDependency):
+    """
+    Streams status changes and stats of every server.
+
+    Events that arrive together, like the stats from one sampling pass, are sent as one `update` frame,
+    which only contains the values that changed since the last frame.
+    """
+    async def event_generator():
+        # last stats sent for each server, so only the ones that changed get sent
+        sent_stats: dict[tuple[str, str], dict] = {}
+        with EventSubscriber(MESSAGE_STREAM_QUEUE_SIZE) as subscriber:
+            subscriber.subscribe(manager, GameServerEventType.STATUS)
+            subscriber.subscribe(manager, GameServerEventType.STATS)
+            while True:
+                events = await subscriber.get_batch()
+
+                if subscriber.take_dropped():
+                    # the client is missing events, so tell it to refetch everything
+                    sent_stats.clear()
+                    yield {
+                        "retry": MESSAGE_STREAM_RETRY_TIMEOUT,
+                        "event": "overflow",
+                        "data": json.dumps({}),
+                    }
+
+                changes: dict[tuple[str, str], dict] = {}
+                for event in events:
+                    key = (event.server.game, event.server.id)
+                    change = changes.setdefault(key, {})
+                    if event.type == GameServerEventType.STATUS:
+                        change["status"] = event.status.name
+                        # stats aren't sampled for stopped servers, so check for them being reset here
+                        stats = event.server.get_stats()
+                    else:
+                        stats = event.stats
+                    last_stats = sent_stats.setdefault(key, {})
+                    changed_stats = {stat: value for stat, value in stats.items() if last_stats.get(stat) != value}
+                    last_stats.update(changed_stats)
+                    if changed_stats:
+                        change.setdefault("stats", {}).update(changed_stats)
+
+                servers = [{"game": game, "id": id, **change} for (game, id), change in changes.items() if change]
+                if servers:
+                    yield {
+                        "retry": MESSAGE_STREAM_RETRY_TIMEOUT,
+                        "event": "update",
+                        "data": json.dumps({"servers": servers}),
+                    }
+    # see the server event stream for why no-transform is needed
+    return EventSourceResponse(event_generator(), headers={"Cache-Control": "no-cache, no-transform"})
 
 @router.post("")
 def create_server(body: dict, manager: ManagerDependency):
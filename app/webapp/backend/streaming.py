@@ -0,0 +1,91 @@
+import asyncio
+from enum import Enum, auto
+
+from app.management.events import GameServerEvent, GameServerEventListener, GameServerEventType
+from app.management.manager import ServerManager
+from app.management.server import GameServer
+
+class OverflowPolicy(Enum):
+    # throw away the oldest queued event to make room for the new one
+    DROP_OLDEST = auto()
+    # throw away the new event and keep what is already queued
+    DROP_NEWEST = auto()
+
+class EventSubscriber:
+    """
+    Hands events emitted by servers to an `asyncio.Queue` as soon as they are emitted.
+
+    Events are usually emitted on other threads, so they are passed to the event loop with `call_soon_threadsafe()`.
+    The queue has a maximum size so that a slow client can't make it grow forever,
+    when it is full events are dropped according to the overflow policy and counted in `dropped`.
+
+    This must be created while an event loop is running, and should be used as a context manager
+    so that the listeners are always removed when the client disconnects.
+    """
+    def __init__(self, maxsize: int = 1000, overflow: OverflowPolicy = OverflowPolicy.DROP_OLDEST):
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue[GameServerEvent] = asyncio.Queue(maxsize)
+        self.overflow = overflow
+        self.dropped = 0
+        self._listeners: list[GameServerEventListener] = []
+
+    def subscribe(self, source: GameServer | ServerManager, filter: GameServerEventType = None):
+        """
+        Starts listening to events from `source`.
+
+        :param source: The server to get events from, or a manager to get events from all of its servers
+        :param filter: Only get events of this type, defaults to None meaning all events
+        """
+        self._listeners.append(source.add_event_listener(self.put, filter))
+
+    def put(self, event: GameServerEvent):
+        """
+        Adds an event to the queue, this is safe to call from any thread.
+        """
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # the loop was closed without the subscriber getting closed first
+            self.close()
+
+    async def get(self):
+        """
+        Waits for the next event.
+        """
+        return await self.queue.get()
+
+    async def get_batch(self):
+        """
+        Waits for the next event, then also takes every other event that is already queued.
+        """
+        events = [await self.queue.get()]
+        while not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        return events
+
+    def take_dropped(self):
+        """
+        Gets the number of events dropped since the last time this was called.
+        """
+        dropped = self.dropped
+        self.dropped = 0
+        return dropped
+
+    def close(self):
+        for listener in self._listeners:
+            listener.deregister()
+        self._listeners.clear()
+
+    def _put(self, event: GameServerEvent):
+        if self.queue.full():
+            self.dropped += 1
+            if self.overflow == OverflowPolicy.DROP_NEWEST:
+                return
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,4 +1,5 @@
 import { useLayoutEffect, useMemo, useRef, useState } from "react";
+import { useQueryClient } from "@tanstack/react-query";
 import { Button, Form, InputGroup } from "react-bootstrap";
 import { useFetchQuery } from "../querys";
 import { getServerEndpoint } from "../utils";
@@ -24,19 +25,56 @@ export default function ServerConsole() {
     auth: true,
   });
 
+  const queryClient = useQueryClient();
+
   const ref = useRef();
+  // distance from the bottom of the console before it updates,
+  // used to keep the same lines in view when older lines are added to the top
+  const scrollBottomRef = useRef(0);
+  const loadingOlderRef = useRef(false);
 
   useLayoutEffect(() => {
-    if (ref.current)// && ref.current.scrollTop === ref.current.scrollHeight - ref.current.clientHeight)
-      ref.current.scrollTop = ref.current.scrollHeight;
+    if (ref.current)
+      ref.current.scrollTop = ref.current.scrollHeight - ref.current.clientHeight - scrollBottomRef.current;
   }, [ref, serverConsole]);
 
+  async function loadOlderLines() {
+    const oldestLine = serverConsole?.lines[0];
+    if (loadingOlderRef.current || oldestLine === undefined || oldestLine.seq <= serverConsole.first_seq)
+      return;
+    loadingOlderRef.current = true;
+    try {
+      const response = await authFetch(`${apiEndpoint}?before=${oldestLine.seq}`);
+      if (!response.ok)
+        return;
+      const page = await response.json();
+      queryClient.setQueryData(queryKey, (data) => ({
+        ...data,
+        first_seq: page.first_seq,
+        lines: [
+          ...page.lines.filter(line => line.seq < (data.lines[0]?.seq ?? Infinity)),
+          ...data.lines,
+        ],
+      }));
+    } finally {
+      loadingOlderRef.current = false;
+    }
+  }
+
+  function onScroll() {
+    const consoleElement = ref.current;
+    // lines streamed in only keep the console scrolled to the bottom if it was already there
+    scrollBottomRef.current = consoleElement.scrollHeight - consoleElement.clientHeight - consoleElement.scrollTop;
+    if (consoleElement.scrollTop === 0)
+      loadOlderLines();
+  }
+
   return (
     <div className="console-wrapper">
-      <div className="console rounded-top" ref={ref}>
-        {isSuccess && serverConsole.lines.map((value, index) => (
+      <div className="console rounded-top" ref={ref} onScroll={onScroll}>
+        {isSuccess && serverConsole.lines.map((value) => (
           // TODO actually color lines instead of just stripping color
-          <div key={index} className={value.error ? "console-line-error" : undefined}>{value.line.replace(/\033\[(.*?)m/g, "")}</div>
+          <div key={value.seq} className={value.error ? "console-line-error" : undefined}>{value.line.replace(/\033\[(.*?)m/g, "")}</div>
         ))}
       </div>
       <Form className="list-group-item"
@@ -8,7 +8,10 @@ import { formatBytes } from '../utils';
 import './dashboard.css';
 import { useFetchMutation, useFetchQuery } from '../querys';
 import { ServerControls, ServerIndicator } from './server';
-import { useState } from 'react';
+import { useEffect, useState } from 'react';
+import { useQueryClient } from '@tanstack/react-query';
+import { EventSourcePolyfill } from 'event-source-polyfill';
+import useAuth from '../hooks/useAuth';
 
 export default function Dashboard() {
   return (
@@ -24,10 +27,35 @@ export function ServerList() {
     queryKey: ['servers'],
     apiEndpoint: '/api/servers',
     auth: true,
-    // TODO make the refetch interval user configurable
-    refetchInterval: 10000,
   });
 
+  const queryClient = useQueryClient();
+  const { auth } = useAuth();
+  // status and stats changes are streamed in, instead of polling the whole list
+  useEffect(() => {
+    const eventSource = new EventSourcePolyfill("/api/servers/stream", { headers: {"Authorization": `Bearer ${auth.access_token}`} });
+
+    eventSource.addEventListener("update", (event) => {
+      const changes = JSON.parse(event.data).servers;
+      queryClient.setQueryData(['servers'], (servers) => servers?.map((server) => {
+        const change = changes.find(change => change.game === server.game.value && change.id === server.id.value);
+        if (change === undefined)
+          return server;
+        return {
+          ...server,
+          status: change.status !== undefined ? { ...server.status, value: change.status } : server.status,
+          stats: change.stats !== undefined ? { ...server.stats, value: { ...server.stats.value, ...change.stats } } : server.stats,
+        };
+      }));
+    });
+
+    eventSource.addEventListener("overflow", (event) => {
+      queryClient.invalidateQueries({ queryKey: ['servers'], exact: true });
+    });
+
+    return () => eventSource.close();
+  }, [queryClient, auth]);
+
   if (isPending) {
     return <span>Loading...</span>
   }
@@ -3,7 +3,7 @@ import { Badge, Button, ButtonGroup, OverlayTrigger, Placeholder, Tab, Tabs, Too
 import ErrorPage, { ResponseError } from "../errors";
 import ServerConsole from "../components/Console";
 import { useServerQuery } from "../querys";
-import { useEffect, useMemo } from "react";
+import { useEffect, useMemo, useRef } from "react";
 import { useQueryClient } from "@tanstack/react-query";
 import ServerSettings from "../components/Settings";
 import ServerFileBrowser from "../components/FileBrowser";
@@ -18,7 +18,7 @@ import useAuthFetch from "../hooks/useAuthFetch";
 
 export function ServerIndicator({ server, className }) {
   return (
-    <OverlayTrigger placement="right" overlay={<Tooltip>{server.status.value.slice(0, 1) + server.status.value.slice(1).toLowerCase()}</Tooltip>}>
+    <OverlayTrigger placement="right" overlay={<Tooltip>{server.status.value.slice(0, 1) + server.status.value.slice(1).toLowerCase().replace("_", " ")}</Tooltip>}>
       <span className={"indicator " + server.status.value.toLowerCase() + (className ? (" " + className) : '')} />
     </OverlayTrigger>
   );
@@ -40,8 +40,8 @@ export function ServerControls({ server, children, ...props }) {
   }
   return (
     <ButtonGroup>
-      <Button disabled={server.status.value !== "STOPPED"} onClick={() => authFetch(apiEndpoint + "/start")} {...props}>{start}</Button>
-      <Button disabled={server.status.value !== "RUNNING"} onClick={() => authFetch(apiEndpoint + "/stop")} {...props}>{stop}</Button>
+      <Button disabled={server.status.value !== "STOPPED" && server.status.value !== "CRASH_LOOP"} onClick={() => authFetch(apiEndpoint + "/start")} {...props}>{start}</Button>
+      <Button disabled={server.status.value !== "RUNNING" && server.status.value !== "QUEUED"} onClick={() => authFetch(apiEndpoint + "/stop")} {...props}>{stop}</Button>
     </ButtonGroup>
   );
 }
@@ -57,20 +57,32 @@ export default function Server() {
   const queryKey = useMemo(() => ["servers", type, serverId], [type, serverId]);
 
   const { auth } = useAuth();
+  // id of the last event received, so a new connection only gets the events that were missed
+  const lastEventIdRef = useRef(null);
   useEffect(() => {
-    const eventSource = new EventSourcePolyfill(apiEndpoint + "/stream", { headers: {"Authorization": `Bearer ${auth.access_token}`} });
+    lastEventIdRef.current = null;
+  }, [apiEndpoint]);
+  useEffect(() => {
+    const resume = lastEventIdRef.current !== null ? "?lastEventId=" + encodeURIComponent(lastEventIdRef.current) : "";
+    const eventSource = new EventSourcePolyfill(apiEndpoint + "/stream" + resume, { headers: {"Authorization": `Bearer ${auth.access_token}`} });
+    const listen = (eventType, handler) => eventSource.addEventListener(eventType, (event) => {
+      if (event.lastEventId)
+        lastEventIdRef.current = event.lastEventId;
+      handler(event);
+    });
 
-    eventSource.addEventListener("console_line", (event) => {
+    // lines that come in close together are sent as one batch
+    listen("console_batch", (event) => {
       queryClient.setQueryData([...queryKey, "console"], (data) => ({
         ...data,
         lines: [
           ...(data?.lines ?? []),
-          JSON.parse(event.data),
+          ...JSON.parse(event.data).lines,
         ]
       }));
     });
 
-    eventSource.addEventListener("status", (event) => {
+    listen("status", (event) => {
       queryClient.setQueryData(queryKey, (data) => ({
         ...data,
         status: {
@@ -80,13 +92,23 @@ export default function Server() {
       }));
     });
 
-    eventSource.addEventListener("console_clear", (event) => {
+    listen("console_clear", (event) => {
       queryClient.setQueryData([...queryKey, "console"], (data) => ({
         ...data,
         lines: [],
       }));
     });
 
+    // the server had to drop events because we couldn't keep up, so just refetch everything
+    eventSource.addEventListener("overflow", (event) => {
+      queryClient.invalidateQueries({ queryKey });
+    });
+
+    // we were gone for too long to get only the events we missed
+    eventSource.addEventListener("resync", (event) => {
+      queryClient.invalidateQueries({ queryKey });
+    });
+
     return () => eventSource.close();
   }, [apiEndpoint, queryKey, queryClient, auth]);
 
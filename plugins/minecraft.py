@@ -39,6 +39,35 @@ class MinecraftServer(GameServer):
     #     if not self.ask_user("Agree to license", answer_type = AnswerType.BOOL):
     #         self.show_error("You need to agree to the license!")
     #         self.cancel()
+    def init(self, **extra_data):
+        self.players: set[str] = set()
+        self.add_trigger(r"]: (\w+) joined the game$", self._on_player_join, regex=True)
+        self.add_trigger(r"]: (\w+) left the game$", self._on_player_leave, regex=True)
+
+    def start_server(self):
+        self.players.clear()
+        return super().start_server()
+
+    def get_command(self):
+        command = super().get_command()
+        if self.hibernate and self.hibernate_server_port is not None:
+            # the manager owns the normal port while hibernating, so the server has to listen somewhere else
+            command += ["--port", str(self.hibernate_server_port)]
+        return command
+
+    def get_memory_reservation(self):
+        # the heap is most of what the jvm uses
+        return self.memory_reservation if self.memory_reservation is not None else self.max_ram
+
+    def get_extra_stats(self):
+        return {"players": len(self.players)}
+
+    def _on_player_join(self, line, match):
+        self.players.add(match[1])
+
+    def _on_player_leave(self, line, match):
+        self.players.discard(match[1])
+
     def setup(self):
         cls = self.__class__
         if cls._version_manifest is None: